@@ -21,3 +21,6 @@ class ExpiredToken(Exception):
 
 class NonExistentUser(Exception):
     pass
+
+class PasswordHashingBusy(Exception):
+    pass
@@ -0,0 +1,29 @@
+from passlib.context import CryptContext
+from functools import lru_cache
+from typing import Optional
+
+
+# this module runs inside the hashing worker processes, so it must stay free of app imports
+
+
+@lru_cache(maxsize=None)
+def get_crypt_context(rounds: int) -> CryptContext:
+    # hashes made with fewer rounds than configured are reported as needing an update
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__rounds=rounds,
+        bcrypt__min_rounds=rounds
+    )
+
+
+def hash_password(password: str, rounds: int) -> str:
+    return get_crypt_context(rounds).hash(password)
+
+
+def verify_password(plain_password: str, hashed_password: str, rounds: int) -> bool:
+    return get_crypt_context(rounds).verify(plain_password, hashed_password)
+
+
+def verify_and_update_password(plain_password: str, hashed_password: str, rounds: int) -> tuple[bool, Optional[str]]:
+    return get_crypt_context(rounds).verify_and_update(plain_password, hashed_password)
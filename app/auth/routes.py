@@ -12,7 +12,7 @@ from app.auth.services import (
 from app.database import get_db
 from app.auth.errors import (
     InvalidCredentials, CredentialsAlreadyTaken, NonExistentPublicKey, 
-    NonExistentChallenge, InvalidSignature
+    NonExistentChallenge, InvalidSignature, PasswordHashingBusy
 )
 
 
@@ -59,6 +59,8 @@ def register_user(user: UserCreate, db: Session = Depends(get_db)) -> UserInfo:
         return create_user(db=db, user=user)
     except CredentialsAlreadyTaken as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except PasswordHashingBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
 
 
 @auth_router.post("/login")
@@ -66,4 +68,6 @@ def login(user: UserLogin, db: Session = Depends(get_db)) -> LoginResponse:
     try:
         return try_login(db=db, provided=user)
     except InvalidCredentials as e:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except PasswordHashingBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
\ No newline at end of file
@@ -39,10 +39,6 @@ class CurrentUser(BaseModel):
 class ChallengeAnswer(BaseModel):
     challenge: str = Field(..., pattern=r'^\d+:[A-Za-z0-9+/=]+$')
     sign: str
-    
-    @property
-    def random_part(self):
-        return self.challenge.split(":")[1]
 
 
 class UserLogin(BaseModel):
@@ -5,11 +5,15 @@ from app.auth.schemas import (
     CurrentUser, LoginResponse, ChallengeString, 
     UserInfo, EmailCheck, UsernameCheck, CheckResult
 )
-from app.auth.utils import hash_password, verify_signature, generate_challenge_string
-from app.models import User, Challenge, Folder
 from app.auth.utils import (
-    verify_password, create_access_token, decode_access_token, 
-    get_user_by_username, get_user_by_email
+    hash_password, verify_signature, generate_challenge_string, 
+    parse_challenge_string, consume_challenge
+)
+from app.models import User, Folder
+from app.folders.utils import add_to_closure
+from app.auth.utils import (
+    verify_and_update_password, create_access_token, decode_access_token, 
+    get_user_by_username, get_user_by_email, get_user_profile
 )
 from app.auth.errors import (
     InvalidCredentials, CredentialsAlreadyTaken, NonExistentPublicKey, 
@@ -62,33 +66,18 @@ def get_full_auth(token: str = Depends(oauth2_scheme), db: Session = Depends(get
 
 def get_user_by_token(token: str, db: Session) -> CurrentUser:
     payload = decode_access_token(token)
-    username = payload.get("sub")
 
-    user = db.query(User).filter(User.username == username).first()
+    try:
+        user_id = int(payload.get("sub"))
+    except (TypeError, ValueError):
+        raise InvalidToken("This token is invalid.")
+
+    profile = get_user_profile(db, user_id)
 
-    if not user:
+    if not profile:
         raise NonExistentUser("This user does not exist.")
-    
-    subscription_start_date = None
-    subscription_end_date = None
-
-    if user.subscription:
-        subscription_start_date = user.subscription.subscription_start_date
-        subscription_end_date = user.subscription.subscription_end_date
-
-    return CurrentUser(
-        username=user.username,
-        email=user.email,
-        public_key=user.public_key,
-        id=user.id,
-        privileged=(payload.get("access_type") == "full"),
-        space_taken=user.space_taken,
-        subscription_name=user.subscription_type.name,
-        subscription_space=user.subscription_type.space,
-        subscription_start_date=subscription_start_date,
-        subscription_end_date=subscription_end_date,
-        customer_id=user.stripe_customer_id
-    )
+
+    return CurrentUser(**profile, privileged=(payload.get("access_type") == "full"))
     
 
 def accept_challenge(public_key: str, challenge: ChallengeAnswer, db: Session) -> LoginResponse:
@@ -97,22 +86,19 @@ def accept_challenge(public_key: str, challenge: ChallengeAnswer, db: Session) -
     if not user:
         raise NonExistentPublicKey("No user found with this public key.")
     
-    challenge_entry = db.query(Challenge).filter(
-        Challenge.user_id == user.id,
-        Challenge.random_chars == challenge.random_part,
-        Challenge.is_used == False
-    ).first()
-
-    if not challenge_entry:
-        raise NonExistentChallenge("This challenge does not exist or has already been used.")
+    parsed = parse_challenge_string(challenge.challenge, public_key)
+
+    if not parsed:
+        raise NonExistentChallenge("This challenge does not exist or has expired.")
     
     if not verify_signature(challenge.challenge, challenge.sign, public_key):
         raise InvalidSignature("Invalid signature.")
     
-    access_token = create_access_token(data={"sub": challenge_entry.user.username, "access_type": "full"})
-
-    challenge_entry.is_used = True
-    db.commit()
+    # only a correctly signed answer uses the challenge up
+    if not consume_challenge(*parsed):
+        raise NonExistentChallenge("This challenge has already been used.")
+    
+    access_token = create_access_token(data={"sub": str(user.id), "access_type": "full"})
 
     return LoginResponse(token=access_token, user=user)
 
@@ -122,32 +108,33 @@ def generate_challenge(public_key: str, db: Session) -> ChallengeString:
     if not user:
         raise NonExistentPublicKey("There is no user with this public key.")
     
-    challenge_str = generate_challenge_string()
-    
-    challenge = Challenge(
-        user_id=user.id,
-        random_chars=challenge_str.split(":")[1],
-        is_used=False
-    )
-
-    db.add(challenge)
-    db.commit()
-
-    return ChallengeString(challenge=challenge_str)
+    return ChallengeString(challenge=generate_challenge_string(public_key))
 
 
 def try_login(db: Session, provided: UserLogin) -> LoginResponse:
     user = get_user_by_username(db, provided.username)
 
-    if not user or (user and not verify_password(provided.password, user.hashed_password)):
+    if not user:
+        raise InvalidCredentials("Incorrect username or password")
+
+    verified, upgraded_hash = verify_and_update_password(provided.password, user.hashed_password)
+
+    if not verified:
         raise InvalidCredentials("Incorrect username or password")
+
+    # hashes made with an older cost factor are replaced while the plain password is at hand
+    if upgraded_hash:
+        user.hashed_password = upgraded_hash
+        db.commit()
     
-    access_token = create_access_token(data={"sub": user.username, "access_type": "limited"})
+    access_token = create_access_token(data={"sub": str(user.id), "access_type": "limited"})
 
     return LoginResponse(token=access_token, user=user)
 
 
 def create_user(db: Session, user: UserCreate) -> UserInfo:
+    hashed_password = hash_password(user.password)
+
     try:
         db.begin()
 
@@ -169,7 +156,7 @@ def create_user(db: Session, user: UserCreate) -> UserInfo:
 
         db_user = User(
             username=user.username,
-            hashed_password=hash_password(user.password),
+            hashed_password=hashed_password,
             email=user.email,
             public_key=user.public_key
         )
@@ -184,6 +171,8 @@ def create_user(db: Session, user: UserCreate) -> UserInfo:
         )
 
         db.add(root_folder)
+        db.flush()
+        add_to_closure(db, root_folder.id, None)
         db.commit()
 
         return UserInfo(
@@ -1,22 +1,136 @@
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes, serialization
 from string import ascii_letters, digits
-from app.auth.errors import ExpiredToken, InvalidToken
+from app.auth.errors import ExpiredToken, InvalidToken, PasswordHashingBusy
+from app.auth import hashing
 from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import event
 from app.models import User
 from app.main import settings
 from loguru import logger
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Callable
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import hashlib
+import heapq
+import hmac
+import secrets
+import threading
+import os
+import time
 import jwt
 import base64
-import random
 
 SECRET_KEY = settings.SECRET_KEY
 ALGORITHM = settings.ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.ACCESS_TOKEN_EXPIRE_MINUTES
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+PASSWORD_HASH_ROUNDS = settings.PASSWORD_HASH_ROUNDS
+
+hashing_pool: Optional[ProcessPoolExecutor] = None
+hashing_pool_lock = threading.Lock()
+hashing_slots: Optional[threading.BoundedSemaphore] = None
+
+
+class ProfileCache:
+    """Bounded LRU of resolved user profiles with a per-entry TTL.
+
+    The cache is per worker, so invalidation only reaches the current process;
+    other workers pick up the change once the entry expires.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[dict]:
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires_at, profile = entry
+            if expires_at < time.monotonic():
+                del self.entries[user_id]
+                return None
+
+            self.entries.move_to_end(user_id)
+            return profile
+
+    def put(self, user_id: int, profile: dict) -> None:
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + self.ttl, profile)
+            self.entries.move_to_end(user_id)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+profile_cache = ProfileCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL_SECONDS)
+
+
+def invalidate_user_profile(user_id: int) -> None:
+    profile_cache.invalidate(user_id)
+
+
+# for changes made inside a caller's transaction: dropped only once it is committed,
+# otherwise a concurrent request could cache the old state again until the entry expires
+def invalidate_user_profile_on_commit(db: Session, user_id: int) -> None:
+    event.listen(db, "after_commit", lambda session: invalidate_user_profile(user_id), once=True)
+
+
+def load_user_profile(db: Session, user_id: int) -> Optional[dict]:
+    user = db.query(User).filter(User.id == user_id).options(
+        joinedload(User.subscription_type), joinedload(User.subscription)
+    ).first()
+
+    if not user:
+        return None
+
+    subscription_start_date = None
+    subscription_end_date = None
+
+    if user.subscription:
+        subscription_start_date = user.subscription.subscription_start_date
+        subscription_end_date = user.subscription.subscription_end_date
+
+    return dict(
+        username=user.username,
+        email=user.email,
+        public_key=user.public_key,
+        id=user.id,
+        space_taken=user.space_taken,
+        subscription_name=user.subscription_type.name,
+        subscription_space=user.subscription_type.space,
+        subscription_start_date=subscription_start_date,
+        subscription_end_date=subscription_end_date,
+        customer_id=user.stripe_customer_id
+    )
+
+
+def get_user_profile(db: Session, user_id: int) -> Optional[dict]:
+    profile = profile_cache.get(user_id)
+    if profile is None:
+        profile = load_user_profile(db, user_id)
+        if profile is not None:
+            profile_cache.put(user_id, profile)
+    return profile
 
 
 def get_user_by_email(db: Session, email: str) -> User:
@@ -27,12 +141,52 @@ def get_user_by_username(db: Session, username: str) -> User:
     return db.query(User).filter(User.username == username).options(joinedload(User.subscription_type)).first()
 
 
+def get_hashing_pool() -> tuple[ProcessPoolExecutor, threading.BoundedSemaphore]:
+    global hashing_pool, hashing_slots
+
+    with hashing_pool_lock:
+        if hashing_pool is None:
+            workers = settings.PASSWORD_HASH_WORKERS or os.cpu_count() or 1
+            # spawned workers don't inherit the locks held by the threads of this process
+            hashing_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            hashing_slots = threading.BoundedSemaphore(workers + settings.PASSWORD_HASH_QUEUE)
+
+        return hashing_pool, hashing_slots
+
+
+def shutdown_hashing_pool() -> None:
+    global hashing_pool, hashing_slots
+
+    with hashing_pool_lock:
+        if hashing_pool is not None:
+            hashing_pool.shutdown(wait=False, cancel_futures=True)
+            hashing_pool = None
+            hashing_slots = None
+
+
+def run_in_hashing_pool(func: Callable, *args):
+    pool, slots = get_hashing_pool()
+
+    # the caller holds a request thread while it waits, so the backlog is capped instead of queued
+    if not slots.acquire(blocking=False):
+        raise PasswordHashingBusy("Too many password operations in progress. Try again later.")
+
+    try:
+        return pool.submit(func, *args).result()
+    finally:
+        slots.release()
+
+
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return run_in_hashing_pool(hashing.hash_password, password, PASSWORD_HASH_ROUNDS)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return run_in_hashing_pool(hashing.verify_password, plain_password, hashed_password, PASSWORD_HASH_ROUNDS)
+
+
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    return run_in_hashing_pool(hashing.verify_and_update_password, plain_password, hashed_password, PASSWORD_HASH_ROUNDS)
 
 
 def create_access_token(data: dict, expires_delta: timedelta = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)) -> str:
@@ -55,10 +209,44 @@ def decode_access_token(token: str) -> dict:
         raise InvalidToken("This token is invalid.")
 
 
+class ReplaySet:
+    """Remembers used challenge nonces until the challenges themselves expire.
+
+    Like the profile cache it lives in the worker's memory.
+    """
+
+    def __init__(self):
+        self.expirations: dict[str, float] = {}
+        self.heap: list[tuple[float, str]] = []
+        self.lock = threading.Lock()
+
+    def add(self, nonce: str, expires_at: float) -> bool:
+        now = time.time()
+
+        with self.lock:
+            while self.heap and self.heap[0][0] < now:
+                _, expired = heapq.heappop(self.heap)
+                self.expirations.pop(expired, None)
+
+            if nonce in self.expirations:
+                return False
+
+            self.expirations[nonce] = expires_at
+            heapq.heappush(self.heap, (expires_at, nonce))
+            return True
+
+
+used_challenges = ReplaySet()
+
+
+@lru_cache(maxsize=settings.PUBLIC_KEY_CACHE_SIZE)
+def load_public_key(public_key: str):
+    return serialization.load_pem_public_key(base64.b64decode(public_key))
+
+
 def verify_signature(challenge: str, signature: str, public_key: str) -> bool:
     try:
-        pub_key_bytes = base64.b64decode(public_key)
-        pub_key = serialization.load_pem_public_key(pub_key_bytes)
+        pub_key = load_public_key(public_key)
         signature_bytes = base64.b64decode(signature)
         challenge_bytes = challenge.encode('utf-8')
 
@@ -75,5 +263,31 @@ def verify_signature(challenge: str, signature: str, public_key: str) -> bool:
         return False
 
 
-def generate_challenge_string() -> str:
-    return f"{int(datetime.utcnow().timestamp())}:{''.join(random.choices(ascii_letters + digits, k=20))}"
+def sign_challenge(public_key: str, issued_at: int, nonce: str) -> str:
+    message = f"{public_key}:{issued_at}:{nonce}".encode('utf-8')
+    return hmac.new(SECRET_KEY.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+# "<issued at>:<nonce><hmac>", the hmac ties the challenge to the key it was issued for
+def generate_challenge_string(public_key: str) -> str:
+    issued_at = int(time.time())
+    nonce = ''.join(secrets.choice(ascii_letters + digits) for _ in range(20))
+    return f"{issued_at}:{nonce}{sign_challenge(public_key, issued_at, nonce)}"
+
+
+def parse_challenge_string(challenge: str, public_key: str) -> Optional[tuple[str, float]]:
+    issued_at, random_part = challenge.split(":", 1)
+    nonce, mac = random_part[:20], random_part[20:]
+
+    if not hmac.compare_digest(mac, sign_challenge(public_key, int(issued_at), nonce)):
+        return None
+
+    expires_at = int(issued_at) + settings.CHALLENGE_EXPIRE_SECONDS
+    if expires_at < time.time():
+        return None
+
+    return nonce, expires_at
+
+
+def consume_challenge(nonce: str, expires_at: float) -> bool:
+    return used_challenges.add(nonce, expires_at)
@@ -6,11 +6,11 @@ class Settings(BaseSettings):
     SECRET_KEY: str # ключ до шифрування jwt-токенів
     ALGORITHM: str # алгоритм шифрування токенів
     ACCESS_TOKEN_EXPIRE_MINUTES: int # термін придатності токенів
-    MINIO_ENDPOINT: str # шлях до minio
-    MINIO_LOGIN: str # логін до minio
-    MINIO_PASSWORD: str # пароль до minio
-    BUCKET_NAME: str # назва бакета minio
-    MINIO_SECURE: bool # чи використовуємо SSL в minio
+    MINIO_ENDPOINT: str = "" # шлях до minio
+    MINIO_LOGIN: str = "" # логін до minio
+    MINIO_PASSWORD: str = "" # пароль до minio
+    BUCKET_NAME: str = "" # назва бакета minio
+    MINIO_SECURE: bool = False # чи використовуємо SSL в minio
     DEBUG_MODE: bool # якщо true, всі get_full_auth використовують get_basic_auth
     TRUSTED_ORIGIN: str # довірений ресурс для звернення
     CORS_DEBUG_MODE: bool # якщо true, звернення дозволені зі всіх джерел
@@ -18,6 +18,63 @@ class Settings(BaseSettings):
     STRIPE_WEBHOOK_SECRET: str # секретний ключ для вебхуків
     PAYMENT_SUCCESS_URL: str # посилання, куди користувача перекине у випадку успішної транзакції
     PAYMENT_FAILURE_URL: str # посилання, куди користувача перекине у випадку провальної транзакції
+    UPLOAD_PART_SIZE: int = 8 * 1024 * 1024 # розмір частини (в байтах) при потоковому завантаженні в minio, мінімум 5 МБ
+    MINIO_PUBLIC_ENDPOINT: str = "" # адреса minio, доступна клієнтам, для підписаних посилань (якщо порожня, береться MINIO_ENDPOINT)
+    MINIO_REGION: str = "us-east-1" # регіон minio, потрібен для підпису посилань без звернення до сервера
+    PRESIGNED_URL_EXPIRE_SECONDS: int = 900 # термін придатності підписаних посилань на завантаження
+    UPLOAD_SESSION_EXPIRE_HOURS: int = 24 # через скільки годин бездіяльності незавершена сесія завантаження видаляється
+    STORAGE_COPY_CONCURRENCY: int = 8 # кількість паралельних копіювань об'єктів у minio
+    BATCH_UPLOAD_MAX_FILES: int = 2000 # максимальна кількість файлів в одному пакетному завантаженні
+    BATCH_UPLOAD_CONCURRENCY: int = 8 # кількість паралельних завантажень у minio при пакетному завантаженні
+    ARCHIVE_READ_AHEAD: int = 4 # скільки об'єктів наперед відкривається з minio під час потокового архівування папки
+    STORAGE_THREADS: int = 100 # кількість потоків для блокуючих звернень до minio, окремо від пулу потоків FastAPI
+    STORAGE_BACKEND: str = "minio" # де зберігаються файли: "minio" або "local" (локальний диск, для одного сервера та тестів навантаження)
+    LOCAL_STORAGE_PATH: str = "storage" # директорія для файлів, якщо STORAGE_BACKEND = "local"
+    STORAGE_MAX_IN_FLIGHT: int = 256 # максимальна кількість одночасних звернень до minio в одному процесі, також розмір пулу з'єднань
+    STORAGE_ACQUIRE_TIMEOUT: float = 30 # скільки секунд звернення чекає на вільне місце, перш ніж отримати помилку
+    STORAGE_CONNECT_TIMEOUT: float = 5 # тайм-аут (в секундах) на з'єднання з minio
+    STORAGE_READ_TIMEOUT: float = 60 # тайм-аут (в секундах) на читання відповіді minio
+    STORAGE_RETRIES: int = 3 # кількість повторних спроб для ідемпотентних запитів до minio
+    STORAGE_RETRY_BACKOFF: float = 0.2 # базова затримка (в секундах) між повторними спробами, до неї додається випадковий розкид
+    STORAGE_DELETION_BATCH: int = 1000 # скільки об'єктів видаляється з minio одним запитом (не більше 1000)
+    STORAGE_DELETION_INTERVAL_SECONDS: int = 5 # як часто фоновий потік перевіряє чергу на видалення
+    STORAGE_DELETION_RETRY_SECONDS: int = 60 # через скільки секунд повторюється невдале видалення об'єкта
+    STORAGE_DELETION_LEASE_SECONDS: int = 600 # на скільки секунд пакет видалень закріплюється за потоком, що його обробляє (має бути більше за найдовший запит до minio з повторами)
+    STORAGE_DELETION_MAX_ATTEMPTS: int = 20 # після скількох невдалих спроб видалення об'єкта припиняється (рядок лишається в черзі без наступної спроби)
+    RECONCILIATION_INTERVAL_HOURS: int = 24 # як часто сховище звіряється з базою даних (0 вимикає звірку)
+    RECONCILIATION_GRACE_HOURS: int = 24 # скільки годин об'єкт без запису в базі не вважається зайвим (він може ще завантажуватись)
+    AUTH_CACHE_SIZE: int = 10000 # скільки профілів користувачів кожен воркер тримає в пам'яті для перевірки токенів
+    AUTH_CACHE_TTL_SECONDS: int = 30 # скільки секунд профіль користувача живе в кеші (0 вимикає кеш)
+    PASSWORD_HASH_ROUNDS: int = 12 # вартість bcrypt; старіші хеші з меншою вартістю оновлюються під час входу
+    PASSWORD_HASH_WORKERS: int = 0 # кількість процесів для хешування паролів (0 - за кількістю ядер)
+    PASSWORD_HASH_QUEUE: int = 8 # скільки запитів на хешування може чекати в черзі понад кількість процесів, решта отримує 503
+    CHALLENGE_EXPIRE_SECONDS: int = 300 # скільки секунд виданий челендж для входу за ключем залишається дійсним
+    PUBLIC_KEY_CACHE_SIZE: int = 1024 # скільки розібраних публічних ключів тримається в пам'яті
+    ADMISSION_TRANSFER_CONCURRENCY: int = 64 # скільки завантажень і вивантажень файлів обробляється одночасно (0 вимикає обмеження)
+    ADMISSION_TRANSFER_QUEUE: int = 128 # скільки таких запитів може чекати в черзі, решта отримує 503
+    ADMISSION_AUTH_CONCURRENCY: int = 16 # скільки запитів входу, реєстрації та зміни пароля обробляється одночасно
+    ADMISSION_AUTH_QUEUE: int = 32 # скільки запитів входу може чекати в черзі
+    ADMISSION_METADATA_CONCURRENCY: int = 256 # скільки решти (легких) запитів обробляється одночасно
+    ADMISSION_METADATA_QUEUE: int = 512 # скільки легких запитів може чекати в черзі
+    ADMISSION_WEBHOOK_CONCURRENCY: int = 8 # скільки вебхуків обробляється одночасно
+    ADMISSION_WEBHOOK_QUEUE: int = 32 # скільки вебхуків може чекати в черзі
+    ADMISSION_QUEUE_TIMEOUT_SECONDS: float = 10 # скільки секунд запит може чекати в черзі, перш ніж отримає 503
+    ADMISSION_RETRY_AFTER_SECONDS: int = 1 # значення заголовка Retry-After у відповідях 503
+    RATE_LIMIT_TRANSFER_PER_MINUTE: float = 600 # скільки завантажень на хвилину дозволено одному клієнту (0 вимикає обмеження)
+    RATE_LIMIT_TRANSFER_BURST: int = 100 # скільки завантажень клієнт може зробити одразу
+    RATE_LIMIT_AUTH_PER_MINUTE: float = 20 # скільки спроб входу на хвилину дозволено одному клієнту
+    RATE_LIMIT_AUTH_BURST: int = 10 # скільки спроб входу клієнт може зробити одразу
+    RATE_LIMIT_METADATA_PER_MINUTE: float = 1200 # скільки легких запитів на хвилину дозволено одному клієнту
+    RATE_LIMIT_METADATA_BURST: int = 200 # скільки легких запитів клієнт може зробити одразу
+    RATE_LIMIT_MAX_CLIENTS: int = 100000 # для скількох клієнтів зберігаються лічильники запитів
+    TREE_LINES_PER_CHUNK: int = 1000 # скільки рядків дерева папок відправляється клієнту одним шматком
+    CHANGE_RETENTION_HOURS: int = 24 * 30 # скільки годин зберігаються події журналу змін; старіший курсор отримує 410
+    CHANGE_SETTLE_SECONDS: int = 5 # через скільки секунд після запису подія віддається клієнтам (щоб не пропустити повільніші транзакції)
+    CHANGE_PRUNE_INTERVAL_MINUTES: int = 60 # як часто журнал змін очищується від застарілих і замінених подій
+    FOLDER_DELETION_BATCH: int = 1000 # скільки файлів або папок видаляється з бази однією транзакцією під час видалення папки
+    FOLDER_DELETION_INTERVAL_SECONDS: int = 30 # як часто фоновий потік перевіряє незавершені видалення папок (наприклад, після перезапуску)
+    MOVE_MAX_ITEMS: int = 10000 # максимальна кількість файлів і папок, що переміщуються одним запитом
+    DOWNLOAD_CHUNK_SIZE: int = 256 * 1024 # розмір шматка (в байтах), яким файл віддається клієнту під час завантаження
 
     class Config:
         env_file = ".env"
\ No newline at end of file
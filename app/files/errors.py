@@ -27,3 +27,34 @@ class CannotShareWithYourself(Exception):
 
 class FileIsNotShared(Exception):
     pass
+
+class InvalidUploadToken(Exception):
+    pass
+
+class UploadedObjectNotFound(Exception):
+    pass
+
+class UploadSessionNotFound(Exception):
+    pass
+
+class InvalidUploadPart(Exception):
+    pass
+
+class IncompleteUpload(Exception):
+    pass
+
+class InvalidBatch(Exception):
+    pass
+
+class FileNotModified(Exception):
+    def __init__(self, etag: str):
+        super().__init__("The file has not been modified.")
+        self.etag = etag
+
+class RangeNotSatisfiable(Exception):
+    def __init__(self, message: str, size: int):
+        super().__init__(message)
+        self.size = size
+
+class PresignedUrlsNotSupported(Exception):
+    pass
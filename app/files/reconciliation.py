@@ -0,0 +1,144 @@
+from sqlalchemy.orm import Session
+from app.models import File
+from app.database import get_db
+from app.files.schemas import ReconciliationReport
+from app.files.utils import storage, enqueue_storage_deletion, notify_storage_deletion
+from app.main import settings
+from loguru import logger
+from datetime import datetime, timedelta, timezone
+from typing import Iterator
+import schedule
+import threading
+import time
+
+
+PAGE_SIZE = 1000
+
+
+# the storage compares names byte-wise, postgres has to sort them the same way
+def byte_ordered(column, db: Session):
+    if db.get_bind().dialect.name == "postgresql":
+        return column.collate("C")
+    return column
+
+
+# keyset pagination, so only one page of rows is in memory at a time
+def iter_file_rows(db: Session) -> Iterator:
+    column = byte_ordered(File.name_in_storage, db)
+    last = None
+
+    while True:
+        query = db.query(File.id, File.name_in_storage)
+        if last is not None:
+            query = query.filter(column > last)
+
+        rows = query.order_by(column).limit(PAGE_SIZE).all()
+
+        # every page is its own short transaction, so a long listing doesn't keep one open (and hold back vacuum)
+        db.commit()
+
+        if not rows:
+            return
+        
+        yield from rows
+        last = rows[-1].name_in_storage
+
+
+def remove_orphans(orphans: list[str], db: Session) -> int:
+    # rows committed since their page was read, e.g. by a copy that was running meanwhile
+    referenced = {
+        row.name_in_storage for row in 
+        db.query(File.name_in_storage).filter(File.name_in_storage.in_(orphans)).all()
+    }
+    orphans = [name for name in orphans if name not in referenced]
+
+    enqueue_storage_deletion(orphans, db)
+    db.commit()
+    notify_storage_deletion()
+
+    return len(orphans)
+
+
+def reconcile_storage(db: Session) -> ReconciliationReport:
+    """
+    Merge join of the object listing with the files table, both walked in the same order.
+    Objects without a row are orphans and are queued for deletion once they are older than
+    the grace period; rows without an object are reported.
+    """
+    threshold = datetime.now(timezone.utc) - timedelta(hours=settings.RECONCILIATION_GRACE_HOURS)
+    report = ReconciliationReport()
+    orphans = []
+
+    objects = storage.iter_objects()
+    rows = iter_file_rows(db)
+
+    obj = next(objects, None)
+    row = next(rows, None)
+
+    while obj is not None or row is not None:
+        if row is None or (obj is not None and obj.name < row.name_in_storage):
+            report.objects_checked += 1
+
+            # recent objects may still be registered by an upload in progress
+            if obj.last_modified < threshold:
+                orphans.append(obj.name)
+            else:
+                report.orphans_in_grace_period += 1
+
+            if len(orphans) >= PAGE_SIZE:
+                report.orphans_deleted += remove_orphans(orphans, db)
+                orphans = []
+            
+            obj = next(objects, None)
+
+        elif obj is None or row.name_in_storage < obj.name:
+            report.rows_checked += 1
+            report.missing_objects += 1
+            logger.debug(f"File {row.id} references a missing object {row.name_in_storage}")
+
+            row = next(rows, None)
+
+        else:
+            report.objects_checked += 1
+            report.rows_checked += 1
+
+            obj = next(objects, None)
+            row = next(rows, None)
+
+    if orphans:
+        report.orphans_deleted += remove_orphans(orphans, db)
+
+    return report
+
+
+def run_reconciliation():
+    db = next(get_db())
+
+    logger.debug(f"{datetime.utcnow()}, reconciling the storage with the database...")
+
+    try:
+        report = reconcile_storage(db)
+        logger.debug(f"Reconciliation finished: {report.model_dump()}")
+    except Exception as e:
+        logger.debug(f"Reconciliation failed: {str(e)}")
+    finally:
+        db.close()
+
+
+def reconciliation_periodic_task():
+    # a dedicated scheduler, so that jobs of other periodic tasks are not run from this thread
+    scheduler = schedule.Scheduler()
+    scheduler.every(settings.RECONCILIATION_INTERVAL_HOURS).hours.do(run_reconciliation)
+    while True:
+        scheduler.run_pending()
+        time.sleep(60)
+
+
+def initiate_reconciliation_task():
+    if settings.RECONCILIATION_INTERVAL_HOURS <= 0:
+        return
+    
+    logger.debug("Starting a thread to reconcile the storage with the database...")
+    task_thread = threading.Thread(target=reconciliation_periodic_task)
+    task_thread.daemon = True
+    task_thread.start()
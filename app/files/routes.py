@@ -1,30 +1,43 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Form
+from fastapi import APIRouter, Depends, HTTPException, status, Form, Query, Header, Request
 from fastapi.responses import Response
 from app.database import get_db
 from app.files.errors import (
     FileAlreadyExistsInThisFolder, FileUploadError, FileRetrieveError, 
     FileDoesNotExist, FileDeletionError, SpaceLimitExceeded,
     DestinationUserDoesNotExist, FileAlreadyShared, CannotShareWithYourself,
-    FileIsNotShared
+    FileIsNotShared, FileNotModified, RangeNotSatisfiable,
+    InvalidUploadToken, UploadedObjectNotFound, UploadSessionNotFound,
+    InvalidUploadPart, IncompleteUpload, InvalidBatch, PresignedUrlsNotSupported
 )
 from app.auth.services import get_basic_auth, get_full_auth
 from app.files.schemas import (
     FileData, FileMetadata, FileResponse, 
     FileRename, SharingDetails, SharingDetailOut,
-    FileMetadataShortened
+    FileMetadataShortened, AbstractFile, PresignedUploadRequest,
+    PresignedUpload, PresignedUploadCompletion, PresignedDownload,
+    UploadSessionCreate, UploadSessionOut, FileCopy, BatchUpload,
+    BatchFileResult
 )
 from sqlalchemy.orm import Session
 from app.folders.errors import FolderNotFound
+from app.storage.errors import StorageSaturated
 from app.files.services import (
     try_upload_file, get_file, try_rename_file, 
     try_delete_file, get_metadata, try_share_file,
-    try_revoke_access, get_shared_data
+    try_revoke_access, get_shared_data, try_upload_file_stream,
+    create_presigned_upload, complete_presigned_upload, get_presigned_download,
+    create_upload_session, get_upload_session, try_upload_part,
+    complete_upload_session, abort_upload_session, try_copy_file,
+    try_upload_batch
 )
-from io import BytesIO
+from app.files.utils import RequestStreamReader, run_in_storage_pool
 from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile
 from app.auth.schemas import CurrentUser
-from typing import Union
+from typing import Union, Annotated, Optional
 from pydantic import ValidationError
+from app.main import settings
 
 
 file_router = APIRouter()
@@ -38,14 +51,14 @@ def get_shared_by_me(
 
 
 @file_router.post("/")
-def upload_file(
+async def upload_file(
     file: str = Form(...),
     current_user: CurrentUser = Depends(get_full_auth),
     db: Session = Depends(get_db)
 ) -> FileResponse:
     try:
         file_data = FileData.parse_raw(file)
-        file_id = try_upload_file(current_user, file_data, db)
+        file_id = await run_in_storage_pool(try_upload_file, current_user, file_data, db)
         return FileResponse(file_id=file_id)
     
     except ValidationError as e:
@@ -55,23 +68,252 @@ def upload_file(
         )
     except FolderNotFound as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
     except FileUploadError as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     except (FileAlreadyExistsInThisFolder, SpaceLimitExceeded) as e:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
 
 
+# multipart form: "metadata" holds a BatchUpload json, "files" are in the same order as its entries
+@file_router.post("/batch")
+async def upload_batch(
+    request: Request,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)
+) -> list[BatchFileResult]:
+    try:
+        # parsed by hand, since the default form limits allow only 1000 files
+        async with request.form(
+            max_files=settings.BATCH_UPLOAD_MAX_FILES, 
+            max_fields=settings.BATCH_UPLOAD_MAX_FILES + 1
+        ) as form:
+            batch = BatchUpload.model_validate_json(form.get("metadata") or "")
+            contents = form.getlist("files")
+
+            if not all(isinstance(content, UploadFile) for content in contents):
+                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Every "files" part must be a file.')
+
+            return await run_in_storage_pool(try_upload_batch, current_user, batch, contents, db)
+    
+    except ValidationError as e:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=e.errors()
+        )
+    except InvalidBatch as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except FolderNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
+# raw ciphertext in the body, metadata in the query string
+@file_router.post("/stream")
+async def upload_file_stream(
+    request: Request,
+    metadata: Annotated[AbstractFile, Query()],
+    content_length: Optional[int] = Header(None),
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)
+) -> FileResponse:
+    if content_length is None:
+        raise HTTPException(status_code=status.HTTP_411_LENGTH_REQUIRED, detail="Content-Length is required.")
+    
+    try:
+        reader = RequestStreamReader(request)
+        file_id = await try_upload_file_stream(current_user, metadata, reader, content_length, db)
+        return FileResponse(file_id=file_id)
+    
+    except FolderNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except FileUploadError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    except (FileAlreadyExistsInThisFolder, SpaceLimitExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+
+
+@file_router.post("/presigned")
+def presigned_upload(
+    request: PresignedUploadRequest,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> PresignedUpload:
+    try:
+        return create_presigned_upload(current_user, request, db)
+    except PresignedUrlsNotSupported as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    except FolderNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except (FileAlreadyExistsInThisFolder, SpaceLimitExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+
+
+@file_router.post("/presigned/complete")
+def presigned_upload_complete(
+    completion: PresignedUploadCompletion,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> FileResponse:
+    try:
+        file_id = complete_presigned_upload(current_user, completion, db)
+        return FileResponse(file_id=file_id)
+    except InvalidUploadToken as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except (FolderNotFound, UploadedObjectNotFound) as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except (FileUploadError, FileDeletionError) as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    except (FileAlreadyExistsInThisFolder, SpaceLimitExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+
+
+@file_router.post("/sessions")
+def start_upload_session(
+    request: UploadSessionCreate,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> UploadSessionOut:
+    try:
+        return create_upload_session(current_user, request, db)
+    except FolderNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except InvalidUploadPart as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except FileUploadError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    except (FileAlreadyExistsInThisFolder, SpaceLimitExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+    
+
+@file_router.get("/sessions/{session_id}")
+def upload_session_state(
+    session_id: str,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> UploadSessionOut:
+    try:
+        return get_upload_session(current_user, session_id, db)
+    except UploadSessionNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
+@file_router.put("/sessions/{session_id}/parts/{part_number}")
+async def upload_session_part(
+    request: Request,
+    session_id: str,
+    part_number: int,
+    content_length: Optional[int] = Header(None),
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> Response:
+    if content_length is None:
+        raise HTTPException(status_code=status.HTTP_411_LENGTH_REQUIRED, detail="Content-Length is required.")
+    
+    try:
+        reader = RequestStreamReader(request)
+        await try_upload_part(current_user, session_id, part_number, reader, content_length, db)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    except UploadSessionNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except InvalidUploadPart as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except FileUploadError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@file_router.post("/sessions/{session_id}/complete")
+def upload_session_complete(
+    session_id: str,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> FileResponse:
+    try:
+        file_id = complete_upload_session(current_user, session_id, db)
+        return FileResponse(file_id=file_id)
+    except (UploadSessionNotFound, FolderNotFound) as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except IncompleteUpload as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except FileUploadError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    except (FileAlreadyExistsInThisFolder, SpaceLimitExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+    
+
+@file_router.delete("/sessions/{session_id}")
+def upload_session_abort(
+    session_id: str,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> Response:
+    try:
+        abort_upload_session(current_user, session_id, db)
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    except UploadSessionNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except FileDeletionError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
+@file_router.get("/{file_id}/presigned")
+def presigned_download(
+    file_id: int,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> PresignedDownload:
+    try:
+        return get_presigned_download(current_user, file_id, db)
+    except PresignedUrlsNotSupported as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
+    except FileDoesNotExist as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
 @file_router.get("/{file_id}")
-def get_file_contents(
+async def get_file_contents(
     file_id: int, 
+    range: Optional[str] = Header(None),
+    if_range: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
     current_user: CurrentUser = Depends(get_full_auth), 
     db: Session = Depends(get_db)) -> StreamingResponse:
     try:
-        bytes = get_file(current_user, file_id, db)
-        transformed = BytesIO(bytes)
-        return StreamingResponse(transformed, media_type="application/octet-stream")
+        stream = await run_in_storage_pool(get_file, current_user, file_id, db, range, if_range, if_none_match)
+        
+        headers = {
+            "Content-Length": str(stream.content_length),
+            "Accept-Ranges": "bytes",
+            "ETag": stream.etag
+        }
+
+        if stream.byte_range:
+            headers["Content-Range"] = stream.content_range
+
+        # the background task also runs when the client disconnects mid-transfer
+        return StreamingResponse(
+            stream, 
+            status_code=(status.HTTP_206_PARTIAL_CONTENT if stream.byte_range else status.HTTP_200_OK),
+            media_type="application/octet-stream",
+            headers=headers,
+            background=BackgroundTask(stream.close)
+        )
+    except FileNotModified as e:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": e.etag})
+    except RangeNotSatisfiable as e:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, 
+            detail=str(e),
+            headers={"Content-Range": f"bytes */{e.size}"}
+        )
     except FileDoesNotExist as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
     except FileRetrieveError as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     
@@ -79,10 +321,16 @@ def get_file_contents(
 @file_router.get("/{file_id}/params")
 def get_file_parameters(
     file_id: int, 
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
     current_user: CurrentUser = Depends(get_basic_auth), 
     db: Session = Depends(get_db)) -> Union[FileMetadata, FileMetadataShortened]:
     try:
-        return get_metadata(current_user, file_id, db)
+        metadata, etag = get_metadata(current_user, file_id, db, if_none_match)
+        response.headers["ETag"] = etag
+        return metadata
+    except FileNotModified as e:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": e.etag})
     except FileDoesNotExist as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
 
@@ -116,6 +364,25 @@ def delete_file(
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     
 
+@file_router.post("/{file_id}/copy")
+async def copy_file(
+    copy: FileCopy,
+    file_id: int,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> FileResponse:
+    try:
+        file_id = await run_in_storage_pool(try_copy_file, current_user, file_id, copy, db)
+        return FileResponse(file_id=file_id)
+    except (FileDoesNotExist, FolderNotFound) as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except FileUploadError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+    except (FileAlreadyExistsInThisFolder, SpaceLimitExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+
+
 @file_router.post("/{file_id}/share/{user_id}")
 def share_file(
     sharing_details: SharingDetails,
@@ -49,10 +49,71 @@ class FileResponse(BaseModel):
     file_id: int
 
 
+class PresignedUploadRequest(AbstractFile):
+    size: int = Field(..., gt=0)
+
+
+class PresignedUpload(BaseModel):
+    url: str
+    upload_token: str
+    expires_in: int
+
+
+class PresignedUploadCompletion(BaseModel):
+    upload_token: str
+
+
+class PresignedDownload(BaseModel):
+    url: str
+    expires_in: int
+
+
+class UploadSessionCreate(AbstractFile):
+    size: int = Field(..., gt=0)
+
+
+class UploadSessionOut(BaseModel):
+    session_id: str
+    part_size: int
+    part_count: int
+    received: list[int]
+
+
+class BatchFileMetadata(BaseModel):
+    name: str = Field(..., min_length=2, max_length=128)
+    type: FileType
+    format: str
+    encrypted_key: str
+    encrypted_iv: str
+
+
+class BatchUpload(BaseModel):
+    folder_id: int
+    files: list[BatchFileMetadata]
+
+
+class BatchFileStatus(str, Enum):
+    CREATED = "CREATED"
+    DUPLICATE = "DUPLICATE"
+    SPACE_LIMIT_EXCEEDED = "SPACE_LIMIT_EXCEEDED"
+    FAILED = "FAILED"
+
+
+class BatchFileResult(BaseModel):
+    name: str
+    status: BatchFileStatus
+    file_id: Optional[int] = None
+
+
 class FileRename(BaseModel):
     new_name: str = Field(..., min_length=2, max_length=128)
 
 
+class FileCopy(BaseModel):
+    folder_id: int
+    name: Optional[str] = Field(None, min_length=2, max_length=128)
+
+
 class SharingDetails(BaseModel):
     enc_key: str
     enc_iv: str
@@ -71,3 +132,11 @@ class SharingDetailOut(BaseModel):
     class Config:
         from_attributes = True
 
+
+
+class ReconciliationReport(BaseModel):
+    objects_checked: int = 0
+    rows_checked: int = 0
+    orphans_deleted: int = 0
+    orphans_in_grace_period: int = 0
+    missing_objects: int = 0
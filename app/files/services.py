@@ -1,75 +1,437 @@
-from app.files.schemas import FileData
-from sqlalchemy import select, func, Integer
+from app.files.schemas import FileData, AbstractFile
+from sqlalchemy import select, func, Integer, insert
 from sqlalchemy.orm import Session
-from app.folders.utils import get_folder
+from app.folders.utils import get_folder, bump_folder_versions
 from app.files.utils import (
-    save_to_storage, remove_from_storage, check_duplicate_file, 
-    retrieve_from_storage, retrieve_file_from_id, get_file_size_gb,
-    increment_user_space, decrement_user_space, get_shared_state,
-    get_shared_users_for_file
+    save_to_storage, enqueue_storage_deletion, check_duplicate_file, 
+    stat_storage_object, retrieve_file_from_id, get_file_size_gb,
+    reserve_user_space, release_user_space, get_shared_state,
+    get_shared_users_for_file, pipe_to_storage, StorageStream,
+    etag_matches, parse_range_header, retrieve_storage_name,
+    generate_filename, presign_upload, presign_download,
+    create_upload_token, decode_upload_token, is_upload_token_used, get_uploaded_size,
+    get_part_count, check_part, start_multipart_upload, upload_part_to_storage,
+    complete_multipart_upload, abort_multipart_upload, retrieve_upload_session,
+    construct_session_model, copy_in_storage, bulk_stream_to_storage,
+    RequestStreamReader, run_in_storage_pool, notify_storage_deletion,
+    space_reservation, commit_space_reservation, cancel_space_reservation,
+    get_file_params_etag
 )
 from app.models import (
-    File, User, SharedFile
+    File, User, SharedFile, UploadSession, UploadPart
 )
 from app.auth.schemas import CurrentUser
 from app.files.schemas import (
     FileMetadata, SharingDetails, SharingDetailOut,
-    SharingDetailOut, FileMetadataShortened
+    SharingDetailOut, FileMetadataShortened, PresignedUploadRequest,
+    PresignedUpload, PresignedUploadCompletion, PresignedDownload,
+    UploadSessionCreate, UploadSessionOut, FileCopy, BatchUpload,
+    BatchFileResult, BatchFileStatus
 )
 from app.folders.schemas import FolderMember
+from app.sync.schemas import ChangeEntity, ChangeAction
+from app.sync.utils import record_change, record_changes, change_row
 from loguru import logger
+from fastapi.concurrency import run_in_threadpool
 from app.main import settings
 from app.files.errors import (
     SpaceLimitExceeded, DestinationUserDoesNotExist, FileAlreadyShared,
-    CannotShareWithYourself, FileIsNotShared, FileDoesNotExist
+    CannotShareWithYourself, FileIsNotShared, FileDoesNotExist,
+    FileNotModified, InvalidUploadToken, InvalidUploadPart, IncompleteUpload,
+    InvalidBatch
 )
-from typing import Union
+from typing import Union, Optional
+from datetime import datetime
+import anyio
+import uuid
 
 
 def try_upload_file(current_user: CurrentUser, file: FileData, db: Session) -> int:
     file_size = get_file_size_gb(file)
 
-    if current_user.space_taken + file_size > current_user.subscription_space:
-        raise SpaceLimitExceeded("Space limit exceeded.")
-
     # checking if the user owns this folder
     get_folder(current_user.id, file.folder_id, db)
     # checking for duplicates in naming
     check_duplicate_file(file.folder_id, file.name, db)
-    # trying to save in bucket
-    filename = save_to_storage(current_user.username, file, file.name)
-    # (all exceptions are thrown internally)
+
+    # released again if anything below fails
+    with space_reservation(current_user.id, file_size, db):
+        # trying to save in bucket
+        filename = save_to_storage(current_user.username, file, file.name)
+        # (all exceptions are thrown internally)
+        file_wrapper = File(
+            **file.model_dump(exclude="content"),
+            name_in_storage = filename,
+            size = file_size
+        )
+
+        db.add(file_wrapper)
+        db.flush()
+        bump_folder_versions(db, [file_wrapper.folder_id])
+        record_change(db, current_user.id, ChangeEntity.FILE, ChangeAction.CREATE, file_wrapper.id, file_wrapper.folder_id, file_wrapper.name)
+        db.commit()
+        db.refresh(file_wrapper)
+
+    return file_wrapper.id
+
+
+async def try_upload_file_stream(
+    current_user: CurrentUser, 
+    metadata: AbstractFile, 
+    reader: RequestStreamReader, 
+    length: int, 
+    db: Session) -> int:
+    file_size = length / (1024 ** 3)
+
+    await run_in_threadpool(check_upload_destination, current_user, metadata, db)
+
+    # reserved before a single byte of the body is read
+    await run_in_threadpool(commit_space_reservation, current_user.id, file_size, db)
+
+    try:
+        filename = await pipe_to_storage(current_user.username, reader, length, metadata.name)
+        return await run_in_threadpool(register_uploaded_file, current_user.id, metadata, filename, file_size, db)
+    except BaseException:
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(cancel_space_reservation, current_user.id, file_size, db)
+        raise
+
+
+def check_upload_destination(current_user: CurrentUser, metadata: AbstractFile, db: Session) -> None:
+    get_folder(current_user.id, metadata.folder_id, db)
+    check_duplicate_file(metadata.folder_id, metadata.name, db)
+
+
+def register_uploaded_file(user_id: int, metadata: AbstractFile, filename: str, file_size: float, db: Session) -> int:
     file_wrapper = File(
-        **file.model_dump(exclude="content"),
+        **metadata.model_dump(),
         name_in_storage = filename,
         size = file_size
     )
 
     db.add(file_wrapper)
-
-    increment_user_space(current_user.id, file_size, db)
-
+    db.flush()
+    bump_folder_versions(db, [file_wrapper.folder_id])
+    record_change(db, user_id, ChangeEntity.FILE, ChangeAction.CREATE, file_wrapper.id, file_wrapper.folder_id, file_wrapper.name)
     db.commit()
     db.refresh(file_wrapper)
 
     return file_wrapper.id
 
 
-def get_file(current_user: CurrentUser, file_id: int, db: Session) -> bytes:
+def try_upload_batch(current_user: CurrentUser, batch: BatchUpload, contents: list, db: Session) -> list[BatchFileResult]:
+    if len(contents) != len(batch.files):
+        raise InvalidBatch("Every uploaded file must have exactly one metadata entry.")
+    
+    # a single ownership check and a single duplicate lookup for the whole batch
+    get_folder(current_user.id, batch.folder_id, db)
+
+    names = [metadata.name for metadata in batch.files]
+    taken = set(db.scalars(select(File.name).where(File.folder_id == batch.folder_id, File.name.in_(names))))
+
+    results = [BatchFileResult(name=metadata.name, status=BatchFileStatus.CREATED) for metadata in batch.files]
+    sizes = [content.size / (1024 ** 3) for content in contents]
+    candidates = []
+
+    for index, metadata in enumerate(batch.files):
+        if metadata.name in taken:
+            results[index].status = BatchFileStatus.DUPLICATE
+        else:
+            taken.add(metadata.name)
+            candidates.append(index)
+
+    accepted = reserve_batch_space(current_user.id, candidates, sizes, db)
+
+    for index in set(candidates) - set(accepted):
+        results[index].status = BatchFileStatus.SPACE_LIMIT_EXCEEDED
+
+    reserved = sum(sizes[index] for index in accepted)
+    stored = []
+
+    try:
+        filenames = bulk_stream_to_storage(
+            current_user.username, 
+            [(batch.files[index].name, contents[index].file, contents[index].size) for index in accepted]
+        )
+
+        for index, filename in zip(accepted, filenames):
+            if filename is None:
+                results[index].status = BatchFileStatus.FAILED
+                release_user_space(current_user.id, sizes[index], db)
+            else:
+                stored.append((index, filename))
+
+        file_ids = []
+
+        if stored:
+            file_ids = db.execute(
+                insert(File).returning(File.id, sort_by_parameter_order=True),
+                [
+                    {
+                        **batch.files[index].model_dump(),
+                        "folder_id": batch.folder_id,
+                        "name_in_storage": filename,
+                        "size": sizes[index]
+                    }
+                    for index, filename in stored
+                ]
+            ).scalars().all()
+
+            bump_folder_versions(db, [batch.folder_id])
+            record_changes(db, [
+                change_row(current_user.id, ChangeEntity.FILE, ChangeAction.CREATE, file_id, batch.folder_id, batch.files[index].name)
+                for (index, _), file_id in zip(stored, file_ids)
+            ])
+
+        db.commit()
+    except BaseException:
+        cancel_space_reservation(current_user.id, reserved, db)
+
+        # the objects are already in the storage, without rows they are removed again by the drainer
+        enqueue_storage_deletion([filename for _, filename in stored], db)
+        db.commit()
+        notify_storage_deletion()
+        raise
+
+    for (index, _), file_id in zip(stored, file_ids):
+        results[index].file_id = file_id
+
+    return results
+
+
+# one statement for the whole batch when it fits, otherwise file by file in the batch order
+def reserve_batch_space(user_id: int, candidates: list[int], sizes: list[float], db: Session) -> list[int]:
+    try:
+        reserve_user_space(user_id, sum(sizes[index] for index in candidates), db)
+        db.commit()
+        return candidates
+    except SpaceLimitExceeded:
+        db.rollback()
+
+    accepted = []
+
+    for index in candidates:
+        try:
+            reserve_user_space(user_id, sizes[index], db)
+            accepted.append(index)
+        except SpaceLimitExceeded:
+            pass
+
+    db.commit()
+
+    return accepted
+
+
+def get_file(
+    current_user: CurrentUser, 
+    file_id: int, 
+    db: Session,
+    byte_range: Optional[str] = None,
+    if_range: Optional[str] = None,
+    if_none_match: Optional[str] = None) -> StorageStream:
     logger.debug(f"current_user = {current_user}, file_id = {file_id}")
     
+    filename = retrieve_storage_name(current_user.id, file_id, db)
+
+    stream = stat_storage_object(filename)
+
+    if if_none_match and etag_matches(if_none_match, stream.etag):
+        raise FileNotModified(stream.etag)
+    
+    # If-Range only accepts strong validators, a date or a stale etag means the whole file
+    if byte_range and (if_range is None or if_range.strip() == stream.etag):
+        stream.byte_range = parse_range_header(byte_range, stream.size)
+
+    stream.open()
+
+    return stream
+
+
+def create_presigned_upload(current_user: CurrentUser, request: PresignedUploadRequest, db: Session) -> PresignedUpload:
+    # only an early rejection, the space is reserved when the upload is completed
+    if current_user.space_taken + request.size / (1024 ** 3) > current_user.subscription_space:
+        raise SpaceLimitExceeded("Space limit exceeded.")
+    
+    metadata = AbstractFile(**request.model_dump(exclude={"size"}))
+
+    get_folder(current_user.id, metadata.folder_id, db)
+    check_duplicate_file(metadata.folder_id, metadata.name, db)
+
+    filename = generate_filename(current_user.username, metadata.name)
+
+    return PresignedUpload(
+        url=presign_upload(filename),
+        upload_token=create_upload_token(current_user.id, metadata, filename),
+        expires_in=settings.PRESIGNED_URL_EXPIRE_SECONDS
+    )
+
+
+def complete_presigned_upload(current_user: CurrentUser, completion: PresignedUploadCompletion, db: Session) -> int:
+    metadata, filename = decode_upload_token(current_user.id, completion.upload_token)
+
+    # a token can register its object only once, also after the file was deleted again (its object is then queued for deletion)
+    if is_upload_token_used(filename, db):
+        raise InvalidUploadToken("This upload token has already been used.")
+
+    # the declared size was only a hint, the object itself is what gets accounted
+    file_size = get_uploaded_size(filename) / (1024 ** 3)
+
+    # both could have changed since the url was issued
+    get_folder(current_user.id, metadata.folder_id, db)
+    check_duplicate_file(metadata.folder_id, metadata.name, db)
+
+    # the object is already stored, so the reservation is committed together with the file
     try:
-        file_metadata = retrieve_file_from_id(current_user.id, file_id, db)
+        reserve_user_space(current_user.id, file_size, db)
+    except SpaceLimitExceeded:
+        db.rollback()
+        # a concurrent completion with the same token may have registered the object meanwhile
+        if is_upload_token_used(filename, db):
+            raise InvalidUploadToken("This upload token has already been used.")
+        enqueue_storage_deletion([filename], db)
+        db.commit()
+        notify_storage_deletion()
+        raise
 
-    except FileDoesNotExist as original_error:
-        shared_file = get_shared_state(file_id, current_user.id, db)
+    # the reservation locked the user row, so concurrent completions of the same token are serialized from here on
+    if is_upload_token_used(filename, db):
+        db.rollback()
+        raise InvalidUploadToken("This upload token has already been used.")
 
-        if not shared_file:
-            raise FileDoesNotExist(str(original_error))
-        
-        return retrieve_from_storage(shared_file.file.name_in_storage)
+    file_wrapper = File(
+        **metadata.model_dump(),
+        name_in_storage = filename,
+        size = file_size
+    )
+
+    db.add(file_wrapper)
+    db.flush()
+    bump_folder_versions(db, [file_wrapper.folder_id])
+    record_change(db, current_user.id, ChangeEntity.FILE, ChangeAction.CREATE, file_wrapper.id, file_wrapper.folder_id, file_wrapper.name)
+    db.commit()
+    db.refresh(file_wrapper)
+
+    return file_wrapper.id
 
-    return retrieve_from_storage(file_metadata.name_in_storage)
+
+def get_presigned_download(current_user: CurrentUser, file_id: int, db: Session) -> PresignedDownload:
+    filename = retrieve_storage_name(current_user.id, file_id, db)
+
+    return PresignedDownload(
+        url=presign_download(filename),
+        expires_in=settings.PRESIGNED_URL_EXPIRE_SECONDS
+    )
+
+
+def create_upload_session(current_user: CurrentUser, request: UploadSessionCreate, db: Session) -> UploadSessionOut:
+    # only an early rejection, the space is reserved when the upload is completed
+    if current_user.space_taken + request.size / (1024 ** 3) > current_user.subscription_space:
+        raise SpaceLimitExceeded("Space limit exceeded.")
+    
+    # S3 multipart uploads are limited to 10000 parts
+    if get_part_count(request.size) > 10000:
+        raise InvalidUploadPart("This file is too large for an upload session.")
+    
+    get_folder(current_user.id, request.folder_id, db)
+    check_duplicate_file(request.folder_id, request.name, db)
+
+    filename = generate_filename(current_user.username, request.name)
+
+    session = UploadSession(
+        **request.model_dump(),
+        id=uuid.uuid4().hex,
+        user_id=current_user.id,
+        name_in_storage=filename,
+        upload_id=start_multipart_upload(filename)
+    )
+
+    db.add(session)
+    db.commit()
+    db.refresh(session)
+
+    return construct_session_model(session)
+
+
+def get_upload_session(current_user: CurrentUser, session_id: str, db: Session) -> UploadSessionOut:
+    session = retrieve_upload_session(current_user.id, session_id, db)
+    return construct_session_model(session)
+
+
+async def try_upload_part(
+    current_user: CurrentUser, 
+    session_id: str, 
+    part_number: int, 
+    reader: RequestStreamReader, 
+    length: int, 
+    db: Session) -> None:
+    session = await run_in_threadpool(retrieve_upload_session, current_user.id, session_id, db)
+    check_part(session, part_number, length)
+
+    data = await reader.read(length)
+    if len(data) != length:
+        raise InvalidUploadPart("The part is shorter than its Content-Length.")
+
+    etag = await run_in_storage_pool(upload_part_to_storage, session.name_in_storage, session.upload_id, part_number, data)
+
+    await run_in_threadpool(record_uploaded_part, session, part_number, etag, length, db)
+
+
+def record_uploaded_part(session: UploadSession, part_number: int, etag: str, length: int, db: Session) -> None:
+    # a re-sent part simply replaces the previous one
+    db.merge(UploadPart(session_id=session.id, part_number=part_number, etag=etag, size=length))
+    session.updated_at = datetime.utcnow()
+
+    db.commit()
+
+
+def complete_upload_session(current_user: CurrentUser, session_id: str, db: Session) -> int:
+    session = retrieve_upload_session(current_user.id, session_id, db)
+
+    received = {part.part_number for part in session.parts}
+    missing = [number for number in range(1, get_part_count(session.size) + 1) if number not in received]
+
+    if missing:
+        raise IncompleteUpload(f"Missing parts: {missing[:20]}")
+    
+    file_size = sum(part.size for part in session.parts) / (1024 ** 3)
+    
+    get_folder(current_user.id, session.folder_id, db)
+    check_duplicate_file(session.folder_id, session.name, db)
+
+    with space_reservation(current_user.id, file_size, db):
+        complete_multipart_upload(session.name_in_storage, session.upload_id, session.parts)
+
+        file_wrapper = File(
+            folder_id=session.folder_id,
+            name=session.name,
+            type=session.type,
+            format=session.format,
+            encrypted_key=session.encrypted_key,
+            encrypted_iv=session.encrypted_iv,
+            name_in_storage=session.name_in_storage,
+            size=file_size
+        )
+
+        db.add(file_wrapper)
+        db.delete(session)
+        db.flush()
+
+        bump_folder_versions(db, [file_wrapper.folder_id])
+        record_change(db, current_user.id, ChangeEntity.FILE, ChangeAction.CREATE, file_wrapper.id, file_wrapper.folder_id, file_wrapper.name)
+
+        db.commit()
+        db.refresh(file_wrapper)
+
+    return file_wrapper.id
+
+
+def abort_upload_session(current_user: CurrentUser, session_id: str, db: Session) -> None:
+    session = retrieve_upload_session(current_user.id, session_id, db)
+
+    abort_multipart_upload(session.name_in_storage, session.upload_id)
+
+    db.delete(session)
+    db.commit()
 
 
 def try_rename_file(current_user: CurrentUser, file_id: int, new_name: str, db: Session) -> None:
@@ -77,6 +439,16 @@ def try_rename_file(current_user: CurrentUser, file_id: int, new_name: str, db:
     check_duplicate_file(file.folder_id, new_name, db)
 
     file.name = new_name
+    bump_folder_versions(db, [file.folder_id])
+
+    record_changes(db, [
+        change_row(current_user.id, ChangeEntity.FILE, ChangeAction.RENAME, file.id, file.folder_id, new_name),
+        *(
+            change_row(user_id, ChangeEntity.SHARED_FILE, ChangeAction.RENAME, file.id, name=new_name, peer_user_id=current_user.id)
+            for user_id in get_shared_users_for_file(db, file.id)
+        )
+    ])
+
     db.commit()
 
 
@@ -84,24 +456,76 @@ def try_delete_file(current_user: CurrentUser, file_id: int, db: Session) -> Non
     try:
         file = retrieve_file_from_id(current_user.id, file_id, db)
 
+        bump_folder_versions(db, [file.folder_id])
+
+        record_changes(db, [
+            change_row(current_user.id, ChangeEntity.FILE, ChangeAction.DELETE, file.id, file.folder_id),
+            *(
+                change_row(user_id, ChangeEntity.SHARED_FILE, ChangeAction.DELETE, file.id, peer_user_id=current_user.id)
+                for user_id in get_shared_users_for_file(db, file.id)
+            )
+        ])
+
         db.query(SharedFile).filter(SharedFile.file_id == file_id).delete()
 
-        remove_from_storage(file.name_in_storage)
+        # the object itself is removed by the drainer once this is committed
+        enqueue_storage_deletion([file.name_in_storage], db)
 
-        decrement_user_space(current_user.id, file.size, db)
+        release_user_space(current_user.id, file.size, db)
 
         db.delete(file)
         db.commit()
+
+        notify_storage_deletion()
         
     except Exception as e:
         db.rollback()
         raise e
 
 
+def try_copy_file(current_user: CurrentUser, file_id: int, copy: FileCopy, db: Session) -> int:
+    file = retrieve_file_from_id(current_user.id, file_id, db)
+    name = copy.name or file.name
+    
+    get_folder(current_user.id, copy.folder_id, db)
+    check_duplicate_file(copy.folder_id, name, db)
+
+    with space_reservation(current_user.id, file.size, db):
+        filename = generate_filename(current_user.username, name)
+        copy_in_storage(file.name_in_storage, filename)
+
+        file_wrapper = File(
+            folder_id=copy.folder_id,
+            name=name,
+            type=file.type,
+            format=file.format,
+            encrypted_key=file.encrypted_key,
+            encrypted_iv=file.encrypted_iv,
+            name_in_storage=filename,
+            size=file.size
+        )
+
+        db.add(file_wrapper)
+        db.flush()
+        bump_folder_versions(db, [file_wrapper.folder_id])
+        record_change(db, current_user.id, ChangeEntity.FILE, ChangeAction.CREATE, file_wrapper.id, file_wrapper.folder_id, file_wrapper.name)
+        db.commit()
+        db.refresh(file_wrapper)
+
+    return file_wrapper.id
+
+
 def get_metadata(
     current_user: CurrentUser, 
     file_id: int, 
-    db: Session) -> Union[FileMetadata, FileMetadataShortened]:
+    db: Session,
+    if_none_match: Optional[str] = None) -> tuple[Union[FileMetadata, FileMetadataShortened], str]:
+    # checked before the metadata and the list of recipients are loaded
+    etag = get_file_params_etag(current_user.id, file_id, db)
+
+    if if_none_match and etag_matches(if_none_match, etag):
+        raise FileNotModified(etag)
+
     try:
         file_metadata = retrieve_file_from_id(current_user.id, file_id, db)
     except FileDoesNotExist as e:
@@ -121,7 +545,7 @@ def get_metadata(
             size=shared_file.file.size
         )
 
-    return file_metadata
+    return file_metadata, etag
 
 
 
@@ -130,7 +554,7 @@ def try_share_file(details: SharingDetails, current_user: CurrentUser, dest_user
         raise CannotShareWithYourself("You can't share files with yourself.")
 
     # checking ownership
-    retrieve_file_from_id(current_user.id, file_id, db)
+    file = retrieve_file_from_id(current_user.id, file_id, db)
 
     destination_user = db.query(User).filter(User.id == dest_user_id).first()
     if not destination_user:
@@ -148,12 +572,19 @@ def try_share_file(details: SharingDetails, current_user: CurrentUser, dest_user
     )
 
     db.add(shared_file)
+    bump_folder_versions(db, [file.folder_id])
+
+    record_changes(db, [
+        change_row(current_user.id, ChangeEntity.SHARE, ChangeAction.CREATE, file_id, peer_user_id=dest_user_id),
+        change_row(dest_user_id, ChangeEntity.SHARED_FILE, ChangeAction.CREATE, file_id, name=file.name, peer_user_id=current_user.id)
+    ])
+
     db.commit()
 
 
 def try_revoke_access(current_user: CurrentUser, user_id: int, file_id: int, db: Session) -> None:
     # checking ownership
-    retrieve_file_from_id(current_user.id, file_id, db)
+    file = retrieve_file_from_id(current_user.id, file_id, db)
 
     destination_user = db.query(User).filter(User.id == user_id).first()
     if not destination_user:
@@ -167,6 +598,13 @@ def try_revoke_access(current_user: CurrentUser, user_id: int, file_id: int, db:
         raise FileIsNotShared("This file is not shared with the specified user.")
     
     db.delete(shared_file)
+    bump_folder_versions(db, [file.folder_id])
+
+    record_changes(db, [
+        change_row(current_user.id, ChangeEntity.SHARE, ChangeAction.DELETE, file_id, peer_user_id=user_id),
+        change_row(user_id, ChangeEntity.SHARED_FILE, ChangeAction.DELETE, file_id, peer_user_id=current_user.id)
+    ])
+
     db.commit()
 
 
@@ -1,47 +1,109 @@
-from minio import Minio, S3Error, InvalidResponseError
-from minio.deleteobjects import DeleteObject
-from datetime import datetime
-from app.files.schemas import FileData
+from starlette.requests import Request, ClientDisconnect
+from datetime import datetime, timedelta
+from app.files.schemas import FileData, AbstractFile
+from sqlalchemy import select, insert, update, delete
 from sqlalchemy.orm import Session
-from app.models import File, User, SharedFile
+from app.models import File, Folder, User, SharedFile, UploadSession, UploadPart, StorageDeletion, SubscriptionType
+from app.database import get_db
 from app.files.errors import (
     FileAlreadyExistsInThisFolder, FileUploadError, FileRetrieveError, 
-    FileDoesNotExist, FileDeletionError
+    FileDoesNotExist, FileDeletionError, RangeNotSatisfiable,
+    InvalidUploadToken, UploadedObjectNotFound, UploadSessionNotFound,
+    InvalidUploadPart, PresignedUrlsNotSupported, SpaceLimitExceeded
 )
-from app.files.schemas import FileMetadata
+from app.files.schemas import FileMetadata, UploadSessionOut
 from app.main import settings
+from app.storage.utils import create_storage_backend
+from app.auth.utils import invalidate_user_profile_on_commit
+from app.storage.errors import StorageError, ObjectNotFound, UploadNotFound, OperationNotSupported, StorageSaturated
+from app.storage.base import ObjectReader
 from loguru import logger
-from typing import Optional
+from typing import Optional, BinaryIO, Callable, Iterator, AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import anyio
+import anyio.to_thread
+import schedule
+import threading
+import time
+import math
+import hashlib
+import uuid
+import jwt
 import io
 
-# assuming the bucket is already created
-bucket_name = settings.BUCKET_NAME
-minio_client = Minio(
-    settings.MINIO_ENDPOINT,
-    access_key=settings.MINIO_LOGIN,
-    secret_key=settings.MINIO_PASSWORD,
-    secure=settings.MINIO_SECURE
-)
+storage = create_storage_backend(settings)
+
+# upload tokens are signed with their own key, so they can never pass as access tokens
+UPLOAD_TOKEN_KEY = f"{settings.SECRET_KEY}:presigned-upload"
+
+
+# a single conditional statement, so parallel uploads of one user can't overrun the quota
+def reserve_user_space(user_id: int, space_in_gb: float, db: Session) -> None:
+    limit = select(SubscriptionType.space).where(
+        SubscriptionType.id == User.subscription_type_id
+    ).scalar_subquery()
 
+    reserved = db.execute(
+        update(User)
+        .where(User.id == user_id, User.space_taken + space_in_gb <= limit)
+        .values(space_taken=User.space_taken + space_in_gb)
+        .returning(User.space_taken)
+        .execution_options(synchronize_session=False)
+    ).first()
 
-def increment_user_space(user_id: int, space_in_gb: float, db: Session) -> None:
-    user = db.query(User).filter(User.id == user_id).first()
-    if user:
-        user.space_taken += space_in_gb
+    if reserved is None:
+        raise SpaceLimitExceeded("Space limit exceeded.")
 
+    invalidate_user_profile_on_commit(db, user_id)
 
-def decrement_user_space(user_id: int, space_in_gb: float, db: Session) -> None:
-    user = db.query(User).filter(User.id == user_id).first()
-    if user:
-        user.space_taken -= space_in_gb
+
+def release_user_space(user_id: int, space_in_gb: float, db: Session) -> None:
+    db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(space_taken=User.space_taken - space_in_gb)
+        .execution_options(synchronize_session=False)
+    )
+
+    invalidate_user_profile_on_commit(db, user_id)
+
+
+# the reservation is committed right away, so the row isn't locked while the storage is busy
+def commit_space_reservation(user_id: int, space_in_gb: float, db: Session) -> None:
+    try:
+        reserve_user_space(user_id, space_in_gb, db)
+        db.commit()
+    except SpaceLimitExceeded:
+        db.rollback()
+        raise
+
+
+def cancel_space_reservation(user_id: int, space_in_gb: float, db: Session) -> None:
+    db.rollback()
+    release_user_space(user_id, space_in_gb, db)
+    db.commit()
+
+
+@contextmanager
+def space_reservation(user_id: int, space_in_gb: float, db: Session):
+    commit_space_reservation(user_id, space_in_gb, db)
+
+    try:
+        yield
+    except BaseException:
+        cancel_space_reservation(user_id, space_in_gb, db)
+        raise
 
 
 def get_file_size_gb(file: FileData) -> float:
     return len(file.content) / (1024 ** 3)
 
 
+# the random part keeps names unique when several objects are written within the same second
 def generate_filename(username: str, prefix: str) -> str:
-    return f"{username}-{prefix}-{str(round(datetime.utcnow().timestamp()))}.senc"
+    return f"{username}-{prefix}-{str(round(datetime.utcnow().timestamp()))}-{uuid.uuid4().hex[:8]}.senc"
 
 
 def save_to_storage(username: str, file: FileData, prefix: str) -> str:
@@ -49,23 +111,346 @@ def save_to_storage(username: str, file: FileData, prefix: str) -> str:
     file.content = file.content.encode('utf-8')
 
     try:
-        minio_client.put_object(
-            bucket_name,
-            filename,
-            data = io.BytesIO(file.content),
-            length = len(file.content),
-            content_type = "text/plain"
-        )
+        storage.put(filename, io.BytesIO(file.content), len(file.content))
+        return filename
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileUploadError("An unexpected error occurred while uploading the file: " + str(e))
+
+
+_storage_limiter: Optional[anyio.CapacityLimiter] = None
+
+
+# created lazily, since a limiter can only be made inside the running event loop
+def get_storage_limiter() -> anyio.CapacityLimiter:
+    global _storage_limiter
+
+    if _storage_limiter is None:
+        _storage_limiter = anyio.CapacityLimiter(settings.STORAGE_THREADS)
+    
+    return _storage_limiter
+
+
+# blocking MinIO calls get their own threads, so slow transfers don't starve the FastAPI threadpool
+async def run_in_storage_pool(func: Callable, *args):
+    return await anyio.to_thread.run_sync(partial(func, *args), limiter=get_storage_limiter())
+
+
+async def iterate_in_storage_pool(iterator: Iterator) -> AsyncIterator:
+    while True:
+        chunk = await run_in_storage_pool(next, iterator, None)
+
+        if chunk is None:
+            break
+
+        yield chunk
+
+
+class RequestStreamReader:
+    """
+    Async reader of the request body. Chunks are received on the event loop,
+    so a slow client doesn't hold a thread while its body is being read.
+    """
+
+    def __init__(self, request: Request):
+        self._chunks = request.stream()
+        self._buffer = bytearray()
+        self._exhausted = False
+
+    async def read(self, size: int) -> bytes:
+        while len(self._buffer) < size and not self._exhausted:
+            try:
+                self._buffer += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._exhausted = True
+            except ClientDisconnect:
+                raise FileUploadError("The client disconnected before the upload was finished.")
+
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+
+        return data
+
+
+# only one part of the body is buffered at a time, so memory is bounded by UPLOAD_PART_SIZE
+async def pipe_to_storage(username: str, reader: RequestStreamReader, length: int, prefix: str) -> str:
+    filename = generate_filename(username, prefix)
+
+    if length <= settings.UPLOAD_PART_SIZE:
+        data = await reader.read(length)
+
+        if len(data) != length:
+            raise FileUploadError("The body is shorter than its Content-Length.")
+
+        await run_in_storage_pool(put_bytes_to_storage, filename, data)
+        return filename
+
+    upload_id = await run_in_storage_pool(start_multipart_upload, filename)
+
+    try:
+        parts = []
+
+        for part_number in range(1, get_part_count(length) + 1):
+            part_size = min(settings.UPLOAD_PART_SIZE, length - (part_number - 1) * settings.UPLOAD_PART_SIZE)
+            data = await reader.read(part_size)
+
+            if len(data) != part_size:
+                raise FileUploadError("The body is shorter than its Content-Length.")
+
+            etag = await run_in_storage_pool(upload_part_to_storage, filename, upload_id, part_number, data)
+            parts.append(UploadPart(part_number=part_number, etag=etag))
+
+        await run_in_storage_pool(complete_multipart_upload, filename, upload_id, parts)
+        return filename
+    except BaseException:
+        # shielded, so the parts are dropped even when the request is cancelled
+        with anyio.CancelScope(shield=True):
+            await run_in_storage_pool(abort_multipart_upload, filename, upload_id)
+        raise
+
+
+def put_bytes_to_storage(filename: str, data: bytes) -> None:
+    try:
+        storage.put(filename, io.BytesIO(data), len(data))
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileUploadError("An unexpected error occurred while uploading the file: " + str(e))
+
 
+def stream_to_storage(username: str, stream: BinaryIO, length: int, prefix: str) -> str:
+    filename = generate_filename(username, prefix)
+
+    try:
+        storage.put(filename, stream, length)
         return filename
-    except S3Error as e:
+    except StorageSaturated:
+        raise
+    except StorageError as e:
         raise FileUploadError("An unexpected error occurred while uploading the file: " + str(e))
 
 
+def presign_upload(filename: str) -> str:
+    try:
+        return storage.presign_put(filename, timedelta(seconds=settings.PRESIGNED_URL_EXPIRE_SECONDS))
+    except OperationNotSupported as e:
+        raise PresignedUrlsNotSupported(str(e))
+
+
+def presign_download(filename: str) -> str:
+    try:
+        return storage.presign_get(filename, timedelta(seconds=settings.PRESIGNED_URL_EXPIRE_SECONDS))
+    except OperationNotSupported as e:
+        raise PresignedUrlsNotSupported(str(e))
+
+
+def create_upload_token(user_id: int, metadata: AbstractFile, filename: str) -> str:
+    to_encode = {
+        "uid": user_id,
+        "file": metadata.model_dump(mode="json"),
+        "name_in_storage": filename,
+        "exp": datetime.utcnow() + timedelta(seconds=settings.PRESIGNED_URL_EXPIRE_SECONDS)
+    }
+
+    return jwt.encode(to_encode, UPLOAD_TOKEN_KEY, algorithm=settings.ALGORITHM)
+
+
+def decode_upload_token(user_id: int, token: str) -> tuple[AbstractFile, str]:
+    try:
+        payload = jwt.decode(token, UPLOAD_TOKEN_KEY, algorithms=[settings.ALGORITHM])
+    except jwt.PyJWTError as e:
+        logger.debug(f"Upload token error: {str(e)}")
+        raise InvalidUploadToken("This upload token is invalid or expired.")
+    
+    if payload.get("uid") != user_id:
+        raise InvalidUploadToken("This upload token is invalid or expired.")
+    
+    return AbstractFile(**payload["file"]), payload["name_in_storage"]
+
+
+def is_upload_token_used(filename: str, db: Session) -> bool:
+    return db.query(File).filter(File.name_in_storage == filename).first() is not None or \
+        db.query(StorageDeletion).filter(StorageDeletion.name_in_storage == filename).first() is not None
+
+
+def get_uploaded_size(filename: str) -> int:
+    try:
+        return storage.stat(filename).size
+    except ObjectNotFound:
+        raise UploadedObjectNotFound("The file has not been uploaded to the storage yet.")
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileUploadError("An unexpected error occurred while checking the uploaded file: " + str(e))
+
+
+def get_part_count(size: int) -> int:
+    return math.ceil(size / settings.UPLOAD_PART_SIZE)
+
+
+# every part except the last one has to be exactly UPLOAD_PART_SIZE bytes
+def check_part(session: UploadSession, part_number: int, length: int) -> None:
+    part_count = get_part_count(session.size)
+
+    if part_number < 1 or part_number > part_count:
+        raise InvalidUploadPart(f"Part number must be between 1 and {part_count}.")
+    
+    expected = settings.UPLOAD_PART_SIZE
+    if part_number == part_count:
+        expected = session.size - (part_count - 1) * settings.UPLOAD_PART_SIZE
+
+    if length != expected:
+        raise InvalidUploadPart(f"Part {part_number} must be exactly {expected} bytes.")
+
+
+def start_multipart_upload(filename: str) -> str:
+    try:
+        return storage.create_multipart(filename)
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileUploadError("An unexpected error occurred while starting the upload: " + str(e))
+
+
+def upload_part_to_storage(filename: str, upload_id: str, part_number: int, data: bytes) -> str:
+    try:
+        return storage.upload_part(filename, upload_id, part_number, data)
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileUploadError("An unexpected error occurred while uploading the part: " + str(e))
+
+
+def complete_multipart_upload(filename: str, upload_id: str, parts: list[UploadPart]) -> None:
+    try:
+        storage.complete_multipart(filename, upload_id, [(part.part_number, part.etag) for part in parts])
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileUploadError("An unexpected error occurred while completing the upload: " + str(e))
+
+
+def abort_multipart_upload(filename: str, upload_id: str) -> None:
+    try:
+        storage.abort_multipart(filename, upload_id)
+    except UploadNotFound:
+        # already aborted or completed, nothing is left to clean up
+        pass
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileDeletionError("An unexpected error occurred while aborting the upload: " + str(e))
+
+
+def retrieve_upload_session(user_id: int, session_id: str, db: Session) -> UploadSession:
+    session = db.query(UploadSession).filter(
+        UploadSession.id == session_id, 
+        UploadSession.user_id == user_id
+    ).first()
+
+    if not session:
+        raise UploadSessionNotFound("This upload session does not exist.")
+    
+    return session
+
+
+def construct_session_model(session: UploadSession) -> UploadSessionOut:
+    return UploadSessionOut(
+        session_id=session.id,
+        part_size=settings.UPLOAD_PART_SIZE,
+        part_count=get_part_count(session.size),
+        received=[part.part_number for part in session.parts]
+    )
+
+
+def remove_expired_upload_sessions():
+    db = next(get_db())
+    threshold = datetime.utcnow() - timedelta(hours=settings.UPLOAD_SESSION_EXPIRE_HOURS)
+
+    logger.debug(f"{datetime.utcnow()}, trying to remove expired upload sessions...")
+
+    try:
+        expired = db.query(UploadSession).filter(UploadSession.updated_at < threshold).all()
+
+        for session in expired:
+            try:
+                abort_multipart_upload(session.name_in_storage, session.upload_id)
+            except FileDeletionError as e:
+                logger.debug(f"Could not abort upload session {session.id}: {str(e)}")
+                continue
+
+            db.delete(session)
+            db.commit()
+    finally:
+        db.close()
+
+
+def upload_session_periodic_task():
+    # a dedicated scheduler, so that jobs of other periodic tasks are not run from this thread
+    scheduler = schedule.Scheduler()
+    scheduler.every(10).minutes.do(remove_expired_upload_sessions)
+    while True:
+        scheduler.run_pending()
+        time.sleep(1)
+
+
+def initiate_upload_session_task():
+    logger.debug("Starting a thread to remove expired upload sessions...")
+    task_thread = threading.Thread(target=upload_session_periodic_task)
+    task_thread.daemon = True
+    task_thread.start()
+
+
+def copy_in_storage(source: str, target: str) -> None:
+    try:
+        storage.copy(source, target)
+    except StorageSaturated:
+        raise
+    except StorageError as e:
+        raise FileUploadError("An unexpected error occurred while copying the file: " + str(e))
+
+
+# takes (source, target) pairs; on failure the copies made so far are removed again
+def bulk_copy_in_storage(pairs: list[tuple[str, str]]) -> None:
+    with ThreadPoolExecutor(max_workers=settings.STORAGE_COPY_CONCURRENCY) as executor:
+        futures = [executor.submit(copy_in_storage, source, target) for source, target in pairs]
+
+    failed = [future.exception() for future in futures if future.exception()]
+
+    if failed:
+        copied = [target for (_, target), future in zip(pairs, futures) if not future.exception()]
+        if copied:
+            bulk_remove_from_storage(copied)
+        raise failed[0]
+
+
+# returns the storage name for every stream, or None where the upload failed
+def bulk_stream_to_storage(username: str, items: list[tuple[str, BinaryIO, int]]) -> list[Optional[str]]:
+    with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(stream_to_storage, username, stream, length, prefix) 
+            for prefix, stream, length in items
+        ]
+
+    results = []
+
+    for future in futures:
+        if future.exception():
+            logger.debug(f"Could not upload a file of the batch: {str(future.exception())}")
+            results.append(None)
+        else:
+            results.append(future.result())
+
+    return results
+
+
 def remove_from_storage(file_name: str) -> None:
     try:
-        minio_client.remove_object(bucket_name, file_name)
-    except S3Error as e:
+        storage.delete(file_name)
+    except StorageSaturated:
+        raise
+    except StorageError as e:
         raise FileDeletionError("An unexpected error occurred while deleting the file: " + str(e))
 
 
@@ -73,20 +458,125 @@ def bulk_remove_from_storage(file_names: list[str]) -> None:
     try:
         logger.debug('Trying to delete multiple objects...')
         
-        objects_to_delete = [DeleteObject(file_name) for file_name in file_names]
-        deleted_objects = minio_client.remove_objects(bucket_name, objects_to_delete)
-        
-        for result in deleted_objects:
-            if result.error:
-                logger.debug(f"Failed to delete {result.object_name}: {result.error}")
-            else:
-                logger.debug(f"Successfully deleted {result.object_name}")
+        failed = storage.bulk_delete(file_names)
+        logger.debug(f"Deleted {len(file_names) - len(failed)} of {len(file_names)} objects")
                 
-    except S3Error as e:
+    except StorageSaturated:
+        raise
+    except StorageError as e:
         logger.debug(f'Could not delete multiple objects: {str(e)}')
         raise FileDeletionError(f"An unexpected error occurred while deleting files: {str(e)}")
 
 
+# set whenever new deletions are committed, so the drainer doesn't wait for its next round
+storage_deletion_wakeup = threading.Event()
+
+
+# doesn't commit, the deletion becomes visible together with the rest of the transaction
+def enqueue_storage_deletion(file_names: list[str], db: Session) -> None:
+    if file_names:
+        db.execute(insert(StorageDeletion), [{"name_in_storage": file_name} for file_name in file_names])
+
+
+def notify_storage_deletion() -> None:
+    storage_deletion_wakeup.set()
+
+
+# takes a batch of due rows and pushes their next attempt past the lease, so no other drainer takes them meanwhile
+def claim_storage_deletions(db: Session, now: datetime) -> list:
+    rows = db.query(StorageDeletion.id, StorageDeletion.name_in_storage, StorageDeletion.attempts).filter(
+        StorageDeletion.next_attempt_at <= now
+    ).order_by(StorageDeletion.id).limit(settings.STORAGE_DELETION_BATCH).with_for_update(skip_locked=True).all()
+
+    if rows:
+        db.execute(update(StorageDeletion).where(StorageDeletion.id.in_([row.id for row in rows])).values(
+            next_attempt_at=now + timedelta(seconds=settings.STORAGE_DELETION_LEASE_SECONDS)
+        ))
+
+    db.commit()
+    return rows
+
+
+# removes one batch of due objects, returns how many rows were taken
+def drain_storage_deletions() -> int:
+    db = next(get_db())
+
+    try:
+        rows = claim_storage_deletions(db, datetime.utcnow())
+
+        if not rows:
+            return 0
+        
+        file_names = list({row.name_in_storage for row in rows})
+
+        # no transaction is open while the storage is busy
+        try:
+            failed = set(storage.bulk_delete(file_names))
+        except StorageSaturated:
+            # not the objects' fault, the batch is handed back without counting an attempt
+            db.execute(update(StorageDeletion).where(StorageDeletion.id.in_([row.id for row in rows])).values(
+                next_attempt_at=datetime.utcnow() + timedelta(seconds=settings.STORAGE_DELETION_RETRY_SECONDS)
+            ))
+            db.commit()
+            logger.warning(f"Storage is saturated, {len(rows)} queued deletions are postponed")
+            return 0
+        except StorageError as e:
+            logger.warning(f"Could not delete a batch of {len(file_names)} objects: {str(e)}")
+            failed = set(file_names)
+
+        done_ids = [row.id for row in rows if row.name_in_storage not in failed]
+        failed_rows = [row for row in rows if row.name_in_storage in failed]
+        given_up = [row for row in failed_rows if row.attempts + 1 >= settings.STORAGE_DELETION_MAX_ATTEMPTS]
+        retried_ids = [row.id for row in failed_rows if row.attempts + 1 < settings.STORAGE_DELETION_MAX_ATTEMPTS]
+
+        if done_ids:
+            db.execute(delete(StorageDeletion).where(StorageDeletion.id.in_(done_ids)))
+
+        if retried_ids:
+            db.execute(update(StorageDeletion).where(StorageDeletion.id.in_(retried_ids)).values(
+                attempts=StorageDeletion.attempts + 1,
+                next_attempt_at=datetime.utcnow() + timedelta(seconds=settings.STORAGE_DELETION_RETRY_SECONDS)
+            ))
+
+        if given_up:
+            db.execute(update(StorageDeletion).where(StorageDeletion.id.in_([row.id for row in given_up])).values(
+                attempts=StorageDeletion.attempts + 1,
+                next_attempt_at=None
+            ))
+
+        db.commit()
+
+        if failed_rows:
+            logger.warning(f"Could not delete {len(failed_rows)} queued objects, {len(given_up)} of them won't be retried anymore")
+            for row in given_up:
+                logger.warning(f"Giving up on deleting {row.name_in_storage} after {row.attempts + 1} attempts")
+
+        logger.debug(f"Deleted {len(done_ids)} queued objects, {len(retried_ids)} will be retried")
+        return len(rows)
+    finally:
+        db.close()
+
+
+def storage_deletion_task():
+    while True:
+        try:
+            # a full batch means there's probably more waiting
+            while drain_storage_deletions() == settings.STORAGE_DELETION_BATCH:
+                pass
+        except Exception as e:
+            logger.debug(f"Storage deletion drainer failed: {str(e)}")
+
+        storage_deletion_wakeup.wait(settings.STORAGE_DELETION_INTERVAL_SECONDS)
+        storage_deletion_wakeup.clear()
+
+
+def initiate_storage_deletion_task():
+    logger.debug("Starting a thread to remove queued storage objects...")
+    task_thread = threading.Thread(target=storage_deletion_task)
+    task_thread.daemon = True
+    task_thread.start()
+
+
 # ownership of the folder is already checked in get_folder
 def check_duplicate_file(folder_id: int, file_name: str, db: Session) -> None:
     file = db.query(File).filter(File.folder_id == folder_id, File.name == file_name).first()
@@ -94,16 +584,120 @@ def check_duplicate_file(folder_id: int, file_name: str, db: Session) -> None:
         raise FileAlreadyExistsInThisFolder("A file with this name already exists in this folder.")
 
 
-def retrieve_from_storage(filename: str) -> bytes:
-    try:
-        handle = minio_client.get_object(bucket_name, filename)
-        content = handle.read()
-        handle.close()
+class StorageStream:
+    """
+    Body of a storage object, read from the backend in chunks as they arrive.
+    Only the object stat is fetched on creation, the body is opened by open().
+    The underlying connection (or file) is released on close().
+    """
+
+    def __init__(self, filename: str, size: int, etag: str):
+        self.filename = filename
+        self.size = size
+        self.etag = f'"{etag}"'
+        self.byte_range: Optional[tuple[int, int]] = None
+        self.reader: Optional[ObjectReader] = None
+
+    @property
+    def content_length(self) -> int:
+        if self.byte_range:
+            return self.byte_range[1] - self.byte_range[0] + 1
+        return self.size
+
+    @property
+    def content_range(self) -> str:
+        return f"bytes {self.byte_range[0]}-{self.byte_range[1]}/{self.size}"
 
-        return content
-    except (S3Error, InvalidResponseError) as e:
+    def open(self) -> None:
+        offset, length = 0, 0
+
+        if self.byte_range:
+            offset, length = self.byte_range[0], self.content_length
+
+        try:
+            self.reader = storage.open(self.filename, offset, length)
+        except StorageSaturated:
+            raise
+        except StorageError as e:
+            raise FileRetrieveError("An unexpected error occurred while trying to retrieve the file: " + str(e))
+
+    def __iter__(self):
+        try:
+            yield from self.reader.stream(settings.DOWNLOAD_CHUNK_SIZE)
+        finally:
+            self.close()
+
+    # preferred by StreamingResponse, every chunk is read in the storage pool
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return iterate_in_storage_pool(iter(self))
+
+    def close(self) -> None:
+        if self.reader is not None:
+            self.reader.close()
+
+
+def stat_storage_object(filename: str) -> StorageStream:
+    try:
+        stat = storage.stat(filename)
+        return StorageStream(filename, stat.size, stat.etag)
+    except StorageSaturated:
+        raise
+    except StorageError as e:
         raise FileRetrieveError("An unexpected error occurred while trying to retrieve the file: " + str(e))
+
+
+# skips the stat request, size and etag are taken from the response headers
+def open_storage_stream(filename: str) -> StorageStream:
+    stream = StorageStream(filename, 0, "")
+    stream.open()
+
+    stream.size = stream.reader.size
+    stream.etag = f'"{stream.reader.etag}"'
+
+    return stream
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    
+    # weak comparison, as required for If-None-Match
+    candidates = [candidate.strip().removeprefix("W/") for candidate in header.split(",")]
+    return etag in candidates
+
+
+# only a single range is supported, anything else is ignored and the whole file is sent
+def parse_range_header(header: str, size: int) -> Optional[tuple[int, int]]:
+    unit, _, spec = header.partition("=")
+
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    
+    first, separator, last = spec.strip().partition("-")
+
+    if not separator:
+        return None
+
+    try:
+        if first == "":
+            suffix = int(last)
+            if suffix <= 0:
+                raise RangeNotSatisfiable("The requested range is not satisfiable.", size)
+            start, end = max(size - suffix, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+    except ValueError:
+        return None
+    
+    if start >= size:
+        raise RangeNotSatisfiable("The requested range is not satisfiable.", size)
+    
+    return start, min(end, size - 1)
     
+
 # FileMetadata, since .folder is also loaded
 def retrieve_file_from_id(user_id: int, file_id: int, db: Session) -> FileMetadata:
     file = db.query(File).filter(File.id == file_id).first()
@@ -113,7 +707,8 @@ def retrieve_file_from_id(user_id: int, file_id: int, db: Session) -> FileMetada
     
     folder = file.folder
     
-    if folder.user_id != user_id:
+    # files of a folder being deleted are gone for everyone, even while their rows still exist
+    if folder.user_id != user_id or folder.hidden:
         raise FileDoesNotExist("This file does not exist.")
     
     file.shared = get_shared_users_for_file(db, file_id)
@@ -121,8 +716,40 @@ def retrieve_file_from_id(user_id: int, file_id: int, db: Session) -> FileMetada
     return file
 
 
+# the file is either owned by the user or shared with them
+def retrieve_storage_name(user_id: int, file_id: int, db: Session) -> str:
+    try:
+        return retrieve_file_from_id(user_id, file_id, db).name_in_storage
+    
+    except FileDoesNotExist as original_error:
+        shared_file = get_shared_state(file_id, user_id, db)
+
+        if not shared_file:
+            raise FileDoesNotExist(str(original_error))
+        
+        return shared_file.file.name_in_storage
+
+
+# every change of the metadata (rename, share, revoke) bumps the version of the file's folder
+def get_file_params_etag(user_id: int, file_id: int, db: Session) -> str:
+    row = db.execute(
+        select(File.folder_id, Folder.version, Folder.user_id)
+        .join(Folder, Folder.id == File.folder_id)
+        .where(File.id == file_id, Folder.hidden == False)
+    ).first()
+
+    if not row or (row.user_id != user_id and not get_shared_state(file_id, user_id, db)):
+        raise FileDoesNotExist("This file does not exist.")
+
+    # owners and recipients see different metadata, so the viewer is part of the tag
+    digest = hashlib.sha256(f"{file_id}:{row.folder_id}:{row.version}:{user_id}".encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
 def get_shared_state(file_id: int, user_id: int, db: Session) -> Optional[SharedFile]:
-    return db.query(SharedFile).filter(SharedFile.file_id == file_id, SharedFile.destination_user_id == user_id).first()
+    return db.query(SharedFile).join(File, File.id == SharedFile.file_id).join(Folder, Folder.id == File.folder_id).filter(
+        SharedFile.file_id == file_id, SharedFile.destination_user_id == user_id, Folder.hidden == False
+    ).first()
 
 
 def get_shared_users_for_file(db: Session, file_id: int) -> list[int]:
@@ -6,3 +6,23 @@ class FolderNameAlreadyTakenInParent(Exception):
 
 class CannotModifyRootFolder(Exception):
     pass
+
+class CannotCopyIntoItself(Exception):
+    pass
+
+class CannotMoveIntoItself(Exception):
+    pass
+
+class TooManyItemsToMove(Exception):
+    pass
+
+class DeletionJobNotFound(Exception):
+    pass
+
+class InvalidCursor(Exception):
+    pass
+
+class FolderNotModified(Exception):
+    def __init__(self, etag: str):
+        super().__init__("The folder has not been modified.")
+        self.etag = etag
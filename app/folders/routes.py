@@ -1,20 +1,32 @@
-from fastapi import APIRouter, Depends, status, HTTPException, BackgroundTasks
-from fastapi.responses import Response
+from fastapi import APIRouter, Depends, status, HTTPException, Query, Header
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from urllib.parse import quote
 from sqlalchemy.orm import Session
+from typing import Annotated, Optional
 from app.database import get_db
 from app.auth.services import get_basic_auth, get_full_auth
-from app.folders.errors import FolderNotFound, FolderNameAlreadyTakenInParent, CannotModifyRootFolder
+from app.folders.errors import (
+    FolderNotFound, FolderNameAlreadyTakenInParent, CannotModifyRootFolder,
+    CannotCopyIntoItself, InvalidCursor, FolderNotModified, DeletionJobNotFound,
+    CannotMoveIntoItself, TooManyItemsToMove
+)
 from app.folders.services import (
     get_root_folder, get_specific_folder, create_in_root, 
     create_in_folder, change_folder_name, delete_folder,
-    compute_space, get_shared_with_me
+    compute_space, get_shared_with_me, copy_folder,
+    get_folder_archive, get_folder_tree, get_deletion_job, move_items
 )
 from app.folders.schemas import (
     FolderCreate, FolderPatch, FolderOut,
-    TakenSpace
+    TakenSpace, FolderCopy, FolderListing, FolderDeletionOut,
+    FolderMove
 )
 from app.files.schemas import FileMetadataShortened
 from app.auth.schemas import CurrentUser
+from app.files.errors import SpaceLimitExceeded, FileUploadError, FileAlreadyExistsInThisFolder, FileDoesNotExist
+from app.files.utils import run_in_storage_pool
+from app.storage.errors import StorageSaturated
 
 
 folder_router = APIRouter()
@@ -33,16 +45,72 @@ def get_space(current_user: CurrentUser = Depends(get_basic_auth)) -> TakenSpace
 
 
 @folder_router.get("/")
-def get_root(current_user: CurrentUser = Depends(get_basic_auth), db: Session = Depends(get_db)) -> FolderOut:
-    root_folder = get_root_folder(current_user, db)
-    return root_folder
+def get_root(
+    listing: Annotated[FolderListing, Query()],
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: CurrentUser = Depends(get_basic_auth), 
+    db: Session = Depends(get_db)) -> FolderOut:
+    try:
+        root_folder, etag = get_root_folder(current_user, db, listing, if_none_match)
+        response.headers["ETag"] = etag
+        return root_folder
+    except FolderNotModified as e:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": e.etag})
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+# declared before /{folder_id} so that "tree" isn't taken for an id
+@folder_router.get("/tree")
+def get_tree(current_user: CurrentUser = Depends(get_basic_auth), db: Session = Depends(get_db)) -> StreamingResponse:
+    return StreamingResponse(get_folder_tree(current_user, db), media_type="application/x-ndjson")
+
+
+@folder_router.get("/deletions/{job_id}")
+def deletion_status(
+    job_id: str,
+    current_user: CurrentUser = Depends(get_basic_auth),
+    db: Session = Depends(get_db)) -> FolderDeletionOut:
+    try:
+        return get_deletion_job(current_user, job_id, db)
+    except DeletionJobNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
 
 
 @folder_router.get("/{folder_id}")
-def get_folder(folder_id: int, current_user: CurrentUser = Depends(get_basic_auth), db: Session = Depends(get_db)) -> FolderOut:
+def get_folder(
+    folder_id: int, 
+    listing: Annotated[FolderListing, Query()],
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    current_user: CurrentUser = Depends(get_basic_auth), 
+    db: Session = Depends(get_db)) -> FolderOut:
     try:
-        folder = get_specific_folder(current_user, folder_id, db)
+        folder, etag = get_specific_folder(current_user, folder_id, db, listing, if_none_match)
+        response.headers["ETag"] = etag
         return folder
+    except FolderNotModified as e:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": e.etag})
+    except FolderNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except InvalidCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+
+@folder_router.get("/{folder_id}/archive")
+def folder_archive(
+    folder_id: int, 
+    current_user: CurrentUser = Depends(get_full_auth), 
+    db: Session = Depends(get_db)) -> StreamingResponse:
+    try:
+        archive, name = get_folder_archive(current_user, folder_id, db)
+        return StreamingResponse(
+            archive,
+            media_type="application/x-tar",
+            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(name)}.tar"},
+            background=BackgroundTask(archive.close)
+        )
     except FolderNotFound as e:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
 
@@ -59,6 +127,22 @@ def create_folder_in_root(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
 
 
+# declared before /{folder_id} so that "move" isn't taken for an id
+@folder_router.post("/move")
+def folder_move(
+    move: FolderMove,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> FolderOut:
+    try:
+        return move_items(current_user, move, db)
+    except TooManyItemsToMove as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except (CannotModifyRootFolder, CannotMoveIntoItself, FolderNameAlreadyTakenInParent, FileAlreadyExistsInThisFolder) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+    except (FolderNotFound, FileDoesNotExist) as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
+
 @folder_router.post("/{folder_id}")
 def create_folder_in_folder(
     folder_id: int, 
@@ -74,6 +158,24 @@ def create_folder_in_folder(
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
 
 
+@folder_router.post("/{folder_id}/copy")
+async def folder_copy(
+    folder_id: int,
+    copy: FolderCopy,
+    current_user: CurrentUser = Depends(get_full_auth),
+    db: Session = Depends(get_db)) -> FolderOut:
+    try:
+        return await run_in_storage_pool(copy_folder, current_user, folder_id, copy, db)
+    except (CannotModifyRootFolder, CannotCopyIntoItself, FolderNameAlreadyTakenInParent, SpaceLimitExceeded) as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+    except FolderNotFound as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except StorageSaturated as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
+    except FileUploadError as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+
 @folder_router.patch("/{folder_id}")
 def folder_patch(
     folder_id: int,
@@ -89,15 +191,14 @@ def folder_patch(
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
     
 
-@folder_router.delete("/{folder_id}")
+# the subtree is hidden right away, its progress can be followed at /folders/deletions/{job_id}
+@folder_router.delete("/{folder_id}", status_code=status.HTTP_202_ACCEPTED)
 def folder_delete(
     folder_id: int,
-    background_tasks: BackgroundTasks,
     current_user: CurrentUser = Depends(get_full_auth), 
-    db: Session = Depends(get_db)) -> Response:
+    db: Session = Depends(get_db)) -> FolderDeletionOut:
     try:
-        delete_folder(current_user, folder_id, db, background_tasks)
-        return Response(status_code=status.HTTP_204_NO_CONTENT)
+        return delete_folder(current_user, folder_id, db)
     except CannotModifyRootFolder as e:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
     except FolderNotFound as e:
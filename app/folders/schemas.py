@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import Optional, Literal
+from datetime import datetime
 
 
 class FolderMember(BaseModel):
@@ -18,10 +20,32 @@ class FolderPatch(FolderBase):
     pass
 
 
+class FolderCopy(BaseModel):
+    destination_id: int
+    name: Optional[str] = None
+
+
+class FolderMove(BaseModel):
+    destination_id: int
+    folder_ids: list[int] = []
+    file_ids: list[int] = []
+
+
+class FolderListing(BaseModel):
+    sort: Literal["name", "type", "size", "id"] = "name"
+    desc: bool = False
+    limit: int = Field(200, ge=1, le=1000)
+    cursor: Optional[str] = None
+
+
 class FolderOut(FolderBase):
     id: int
+    path: list["FolderMember"] = []
     folders: list["FolderMember"] = []
     files: list["FileOut"] = []
+    folders_total: int = 0
+    files_total: int = 0
+    next_cursor: Optional[str] = None
 
     class Config:
         from_attributes = True
@@ -37,6 +61,19 @@ class FileOut(BaseModel):
         from_attributes = True
 
 
+class FolderDeletionOut(BaseModel):
+    id: str
+    folder_id: int
+    status: Literal["pending", "done"]
+    files_deleted: int
+    folders_deleted: int
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
 class TakenSpace(BaseModel):
     available: float
     used: float
@@ -1,17 +1,35 @@
+from sqlalchemy import insert, select, update, func
 from sqlalchemy.orm import Session, joinedload
-from app.models import Folder, SharedFile, File
-from app.folders.errors import FolderNameAlreadyTakenInParent, CannotModifyRootFolder
+from app.models import Folder, SharedFile, File, FolderDeletionJob, FolderClosure
+from app.folders.errors import (
+    FolderNameAlreadyTakenInParent, CannotModifyRootFolder, CannotCopyIntoItself,
+    FolderNotModified, DeletionJobNotFound, CannotMoveIntoItself, TooManyItemsToMove
+)
 from app.folders.schemas import (
-    FolderOut, TakenSpace, FolderMember
+    FolderOut, TakenSpace, FolderMember, FolderCopy, FolderListing, FolderDeletionOut,
+    FolderMove
 )
 from app.folders.utils import (
-    delete_folder_task, get_root, get_folder, 
-    folder_exists_in_parent, construct_model
+    hide_subtree, notify_folder_deletion, get_root, get_folder, 
+    folder_exists_in_parent, construct_model, get_subtree,
+    get_file_rows_for_folders, copy_folder_rows, FolderArchive,
+    add_to_closure, copy_closure, is_inside,
+    FolderTree, get_folder_tree_rows, bump_folder_versions, get_folder_etag,
+    get_folders_to_move, get_files_to_move, folder_names_taken, file_names_taken, move_closure,
+    get_nested_in_moved
+)
+from app.files.utils import (
+    etag_matches, generate_filename, bulk_copy_in_storage, enqueue_storage_deletion, notify_storage_deletion, 
+    space_reservation
 )
+from app.files.errors import FileAlreadyExistsInThisFolder
 from app.auth.schemas import CurrentUser
+from app.sync.schemas import ChangeEntity, ChangeAction
+from app.sync.utils import record_change, record_changes, change_row, latest_change_cursor
 from app.files.schemas import FileMetadataShortened
-from fastapi import BackgroundTasks
 from app.main import settings
+from typing import Optional
+import uuid
 
 
 def compute_space(current_user: CurrentUser) -> TakenSpace:
@@ -22,18 +40,33 @@ def compute_space(current_user: CurrentUser) -> TakenSpace:
     )
 
 
-def get_root_folder(current_user: CurrentUser, db: Session) -> FolderOut:
+def get_root_folder(
+    current_user: CurrentUser, 
+    db: Session, 
+    listing: FolderListing = FolderListing(), 
+    if_none_match: Optional[str] = None) -> tuple[FolderOut, str]:
     root_folder = get_root(current_user.id, db)
-    return construct_model(root_folder)
+    return get_specific_folder(current_user, root_folder.id, db, listing, if_none_match)
+
+
+def get_specific_folder(
+    current_user: CurrentUser, 
+    folder_id: int, 
+    db: Session, 
+    listing: FolderListing = FolderListing(), 
+    if_none_match: Optional[str] = None) -> tuple[FolderOut, str]:
+    # the tag is taken before the listing is built, so a concurrent change can only make it look older
+    etag = get_folder_etag(current_user.id, folder_id, listing, db)
 
+    if if_none_match and etag_matches(if_none_match, etag):
+        raise FolderNotModified(etag)
 
-def get_specific_folder(current_user: CurrentUser, folder_id: int, db: Session) -> FolderOut:
     folder = get_folder(current_user.id, folder_id, db)
-    return construct_model(folder)
+    return construct_model(folder, db, listing), etag
 
 
 def create_in_root(current_user: CurrentUser, folder_name: str, db: Session) -> FolderOut:
-    root_folder = get_root_folder(current_user, db)
+    root_folder = get_root(current_user.id, db)
     return create_in_folder(current_user, root_folder.id, folder_name, db)
 
 
@@ -51,10 +84,14 @@ def create_in_folder(current_user: CurrentUser, folder_id: int, folder_name: str
     )
 
     db.add(new_folder)
+    db.flush()
+    add_to_closure(db, new_folder.id, folder_id)
+    bump_folder_versions(db, [folder_id])
+    record_change(db, current_user.id, ChangeEntity.FOLDER, ChangeAction.CREATE, new_folder.id, folder_id, folder_name)
     db.commit()
     db.refresh(new_folder)
 
-    return new_folder
+    return construct_model(new_folder, db)
 
 
 def change_folder_name(current_user: CurrentUser, folder_id: int, folder_name: str, db: Session) -> None:
@@ -67,23 +104,201 @@ def change_folder_name(current_user: CurrentUser, folder_id: int, folder_name: s
         raise FolderNameAlreadyTakenInParent("There is already a folder with the same name in this folder.")
     
     target.name = folder_name
+    bump_folder_versions(db, [target.id, target.parent_id])
+    record_change(db, current_user.id, ChangeEntity.FOLDER, ChangeAction.RENAME, target.id, target.parent_id, folder_name)
 
     db.commit()
     db.refresh(target)
 
 
-def delete_folder(current_user: CurrentUser, folder_id: int, db: Session, background_tasks: BackgroundTasks) -> None:
-    db.expire_on_commit = False
+def delete_folder(current_user: CurrentUser, folder_id: int, db: Session) -> FolderDeletionOut:
     target = get_folder(current_user.id, folder_id, db)
 
     if target.parent_id is None:
         raise CannotModifyRootFolder("Root folder can't be deleted.")
+
+    job = FolderDeletionJob(id=uuid.uuid4().hex, user_id=current_user.id, folder_id=target.id, parent_id=target.parent_id)
+    db.add(job)
+
+    hide_subtree(db, target.id)
+    bump_folder_versions(db, [target.parent_id])
+    record_change(db, current_user.id, ChangeEntity.FOLDER, ChangeAction.DELETE, target.id, target.parent_id)
+
+    db.commit()
+    notify_folder_deletion()
+
+    return FolderDeletionOut.model_validate(job)
+
+
+def get_deletion_job(current_user: CurrentUser, job_id: str, db: Session) -> FolderDeletionOut:
+    job = db.query(FolderDeletionJob).filter(FolderDeletionJob.id == job_id, FolderDeletionJob.user_id == current_user.id).first()
+
+    if not job:
+        raise DeletionJobNotFound("This deletion job does not exist.")
+
+    return FolderDeletionOut.model_validate(job)
+
+
+def copy_folder(current_user: CurrentUser, folder_id: int, copy: FolderCopy, db: Session) -> FolderOut:
+    source = get_folder(current_user.id, folder_id, db)
+
+    if source.parent_id is None:
+        raise CannotModifyRootFolder("Root folder can't be copied.")
+    
+    # checking if destination exists
+    get_folder(current_user.id, copy.destination_id, db)
+
+    if is_inside(db, copy.destination_id, source.id):
+        raise CannotCopyIntoItself("A folder can't be copied into itself.")
+
+    subtree = get_subtree(db, source.id)
+    folder_ids = [row[0] for row in subtree]
+    
+    name = copy.name or source.name
+
+    if folder_exists_in_parent(current_user.id, name, copy.destination_id, db):
+        raise FolderNameAlreadyTakenInParent("There is already a folder with the same name in this folder.")
+    
+    files = get_file_rows_for_folders(db, folder_ids)
+    total_size = sum(file.size for file in files)
+    
+    targets = [generate_filename(current_user.username, file.name) for file in files]
+
+    # reserved once for the whole subtree
+    with space_reservation(current_user.id, total_size, db):
+        bulk_copy_in_storage([(file.name_in_storage, target) for file, target in zip(files, targets)])
+
+        try:
+            id_mapping = copy_folder_rows(db, current_user.id, subtree, copy.destination_id, name)
+            copy_closure(db, source.id, copy.destination_id, id_mapping)
+
+            changes = [
+                change_row(
+                    current_user.id, ChangeEntity.FOLDER, ChangeAction.CREATE, id_mapping[id], 
+                    copy.destination_id if depth == 0 else id_mapping[parent_id], name if depth == 0 else folder_name
+                )
+                for id, parent_id, folder_name, depth in subtree
+            ]
+
+            if files:
+                file_ids = db.execute(insert(File).returning(File.id, sort_by_parameter_order=True), [
+                    {
+                        "folder_id": id_mapping[file.folder_id],
+                        "name": file.name,
+                        "type": file.type,
+                        "format": file.format,
+                        "encrypted_key": file.encrypted_key,
+                        "encrypted_iv": file.encrypted_iv,
+                        "name_in_storage": target,
+                        "size": file.size
+                    }
+                    for file, target in zip(files, targets)
+                ]).scalars().all()
+
+                changes.extend(
+                    change_row(current_user.id, ChangeEntity.FILE, ChangeAction.CREATE, file_id, id_mapping[file.folder_id], file.name)
+                    for file, file_id in zip(files, file_ids)
+                )
+
+            bump_folder_versions(db, [copy.destination_id])
+            record_changes(db, changes)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            enqueue_storage_deletion(targets, db)
+            db.commit()
+            notify_storage_deletion()
+            raise e
     
-    background_tasks.add_task(delete_folder_task, target, db)
+    return construct_model(get_folder(current_user.id, id_mapping[source.id], db), db)
+
+
+# only metadata changes, the objects in the storage stay where they are
+def move_items(current_user: CurrentUser, move: FolderMove, db: Session) -> FolderOut:
+    folder_ids, file_ids = set(move.folder_ids), set(move.file_ids)
+
+    if len(folder_ids) + len(file_ids) > settings.MOVE_MAX_ITEMS:
+        raise TooManyItemsToMove(f"At most {settings.MOVE_MAX_ITEMS} files and folders can be moved at once.")
+
+    destination = get_folder(current_user.id, move.destination_id, db)
+
+    folders = get_folders_to_move(current_user.id, folder_ids, db)
+    files = get_files_to_move(current_user.id, file_ids, db)
+
+    if any(folder.parent_id is None for folder in folders):
+        raise CannotModifyRootFolder("Root folder can't be moved.")
+
+    # the destination must not be one of the moved folders or lie inside one
+    if folders and db.scalar(
+        select(func.count()).select_from(FolderClosure)
+        .where(FolderClosure.ancestor_id.in_(folder_ids), FolderClosure.descendant_id == destination.id)
+    ):
+        raise CannotMoveIntoItself("A folder can't be moved into itself.")
+
+    nested_folders, nested_files = get_nested_in_moved(db, folder_ids, file_ids)
+    folders = [folder for folder in folders if folder.id not in nested_folders]
+    files = [file for file in files if file.id not in nested_files]
+    folder_ids, file_ids = {folder.id for folder in folders}, {file.id for file in files}
+
+    if folders and folder_names_taken(current_user.id, [folder.name for folder in folders], folder_ids, destination.id, db):
+        raise FolderNameAlreadyTakenInParent("There is already a folder with the same name in this folder.")
+
+    if files and file_names_taken([file.name for file in files], file_ids, destination.id, db):
+        raise FileAlreadyExistsInThisFolder("A file with this name already exists in this folder.")
+
+    if folders:
+        db.execute(
+            update(Folder)
+            .where(Folder.id.in_(folder_ids))
+            .values(parent_id=destination.id)
+            .execution_options(synchronize_session=False)
+        )
+
+        move_closure(db, folder_ids, destination.id)
+
+    if files:
+        db.execute(
+            update(File)
+            .where(File.id.in_(file_ids))
+            .values(folder_id=destination.id)
+            .execution_options(synchronize_session=False)
+        )
+
+    bump_folder_versions(db, list({destination.id, *(folder.parent_id for folder in folders), *(file.folder_id for file in files)}))
+
+    # a rename event carries the new parent as well, so a move is reported as one
+    record_changes(db, [
+        *(change_row(current_user.id, ChangeEntity.FOLDER, ChangeAction.RENAME, folder.id, destination.id, folder.name) for folder in folders),
+        *(change_row(current_user.id, ChangeEntity.FILE, ChangeAction.RENAME, file.id, destination.id, file.name) for file in files)
+    ])
+
+    db.commit()
+
+    return construct_model(destination, db)
+
+
+def get_folder_archive(current_user: CurrentUser, folder_id: int, db: Session) -> tuple[FolderArchive, str]:
+    folder = get_folder(current_user.id, folder_id, db)
+
+    subtree = get_subtree(db, folder.id)
+    files = get_file_rows_for_folders(db, [row[0] for row in subtree])
+
+    return FolderArchive(subtree, files), folder.name
+
+
+def get_folder_tree(current_user: CurrentUser, db: Session) -> FolderTree:
+    root_folder = get_root(current_user.id, db)
+
+    # taken first, so changes made while the rows are read are replayed rather than missed
+    cursor = latest_change_cursor(current_user.id, db)
+    folders, files = get_folder_tree_rows(current_user.id, root_folder.id, db)
+
+    return FolderTree(root_folder.id, cursor, folders, files)
 
 
 def get_shared_with_me(db: Session, current_user: CurrentUser) -> list[FileMetadataShortened]:
-    shared_files = db.query(SharedFile).filter(SharedFile.destination_user_id == current_user.id).\
+    shared_files = db.query(SharedFile).join(File, File.id == SharedFile.file_id).join(Folder, Folder.id == File.folder_id).\
+        filter(SharedFile.destination_user_id == current_user.id, Folder.hidden == False).\
         options(joinedload(SharedFile.file).joinedload(File.folder)).all()
     
     file_metadata_list = []
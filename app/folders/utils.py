@@ -1,91 +1,553 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update, delete, func, tuple_, and_, true
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.sql import text
-from app.models import Folder, File, SharedFile
-from app.folders.schemas import FolderMember, FolderOut, FileOut
-from app.folders.errors import FolderNotFound
-from app.files.utils import bulk_remove_from_storage, decrement_user_space
+from app.models import Folder, FolderClosure, File, SharedFile, UploadSession, FolderDeletionJob
+from app.folders.schemas import FolderMember, FolderOut, FileOut, FolderListing
+from app.folders.errors import FolderNotFound, InvalidCursor
+from app.files.utils import (
+    enqueue_storage_deletion, notify_storage_deletion, release_user_space, open_storage_stream, StorageStream,
+    iterate_in_storage_pool, abort_multipart_upload
+)
+from app.files.errors import FileDeletionError, FileDoesNotExist
+from app.database import get_db
+from app.sync.schemas import ChangeEntity, ChangeAction
+from app.sync.utils import record_changes, change_row
+from app.main import settings
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import deque
+from datetime import datetime
 from loguru import logger
-
-
-def traverse_subfolders(db: Session, id: int) -> list[int]:
-    folder_ids = db.execute(text("""
-        WITH RECURSIVE folder_hierarchy AS (
-            SELECT id, parent_id, name
+from typing import AsyncIterator
+import threading
+import tarfile
+import hashlib
+import base64
+import json
+
+
+# fills the closure table from parent_id, for databases created before it existed
+def init_folder_closure(db: Session) -> None:
+    if db.scalar(select(func.count()).select_from(FolderClosure)) or not db.scalar(select(func.count()).select_from(Folder)):
+        return
+
+    db.execute(text("""
+        WITH RECURSIVE closure (ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0
             FROM folders
-            WHERE id = :folder_id
 
             UNION ALL
 
-            SELECT f.id, f.parent_id, f.name
+            SELECT c.ancestor_id, f.id, c.depth + 1
             FROM folders f
-            INNER JOIN folder_hierarchy fh ON f.parent_id = fh.id
+            INNER JOIN closure c ON f.parent_id = c.descendant_id
         )
-        SELECT id FROM folder_hierarchy
-    """), {'folder_id': id}).fetchall()
+        INSERT INTO folder_closure (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, depth FROM closure
+    """))
+    db.commit()
+    logger.debug("Folder closure table filled")
 
-    return [item[0] for item in folder_ids]
 
+def add_to_closure(db: Session, folder_id: int, parent_id: int | None) -> None:
+    db.execute(insert(FolderClosure).values(ancestor_id=folder_id, descendant_id=folder_id, depth=0))
 
-def get_files_for_folders(db: Session, folder_ids: list[int]) -> tuple[list[int], list[str], list[float]]:
-    files = db.execute(text("""
-        WITH RECURSIVE folder_hierarchy AS (
-            SELECT id
-            FROM folders
-            WHERE id IN :folder_ids
+    if parent_id is not None:
+        db.execute(insert(FolderClosure).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            select(FolderClosure.ancestor_id, folder_id, FolderClosure.depth + 1)
+            .where(FolderClosure.descendant_id == parent_id)
+        ))
 
-            UNION ALL
 
-            SELECT f.id
-            FROM folders f
-            INNER JOIN folder_hierarchy fh ON f.parent_id = fh.id
-        )
-        SELECT DISTINCT f.id, f.name_in_storage, f.size
-        FROM files f
-        INNER JOIN folder_hierarchy fh ON f.folder_id = fh.id;
-    """), {"folder_ids": tuple(folder_ids)}).fetchall()
+# closure rows of a copied subtree: its own structure mapped to the new ids, plus the destination's ancestors
+def copy_closure(db: Session, source_id: int, destination_id: int, id_mapping: dict[int, int]) -> None:
+    inner = db.execute(
+        select(FolderClosure.ancestor_id, FolderClosure.descendant_id, FolderClosure.depth)
+        .where(FolderClosure.ancestor_id.in_(select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == source_id)))
+    ).all()
 
-    file_ids = [item[0] for item in files]
-    file_names = [item[1] for item in files]
-    file_sizes = [item[2] for item in files]
+    # hidden folders (being deleted) aren't copied
+    inner = [row for row in inner if row.ancestor_id in id_mapping and row.descendant_id in id_mapping]
 
-    return file_ids, file_names, file_sizes
+    outer = db.execute(
+        select(FolderClosure.ancestor_id, FolderClosure.depth).where(FolderClosure.descendant_id == destination_id)
+    ).all()
 
+    rows = [
+        {"ancestor_id": id_mapping[ancestor_id], "descendant_id": id_mapping[descendant_id], "depth": depth}
+        for ancestor_id, descendant_id, depth in inner
+    ]
 
-def delete_folder_task(folder: Folder, db: Session) -> None:
-    try:
-        with db.begin():
-            logger.debug(f"Working with folder {folder.name}, id = {folder.id}")
+    copied = [(descendant_id, depth) for ancestor_id, descendant_id, depth in inner if ancestor_id == source_id]
+
+    rows.extend(
+        {"ancestor_id": ancestor_id, "descendant_id": id_mapping[descendant_id], "depth": ancestor_depth + depth + 1}
+        for ancestor_id, ancestor_depth in outer
+        for descendant_id, depth in copied
+    )
+
+    db.execute(insert(FolderClosure), rows)
+
+
+# re-links whole subtrees under their new parent in two statements: the links to their old ancestors are dropped,
+# every ancestor of the destination is linked to every folder of the subtrees; none of the folders may lie inside another
+def move_closure(db: Session, folder_ids: set[int], destination_id: int) -> None:
+    subtree = aliased(FolderClosure)
+    subtree_ids = select(subtree.descendant_id).where(subtree.ancestor_id.in_(folder_ids))
+
+    db.execute(
+        delete(FolderClosure)
+        .where(FolderClosure.descendant_id.in_(subtree_ids), FolderClosure.ancestor_id.not_in(subtree_ids))
+        .execution_options(synchronize_session=False)
+    )
+
+    above = aliased(FolderClosure)
+    below = aliased(FolderClosure)
+
+    db.execute(insert(FolderClosure).from_select(
+        ["ancestor_id", "descendant_id", "depth"],
+        select(above.ancestor_id, below.descendant_id, above.depth + below.depth + 1)
+        .select_from(above)
+        .join(below, true())
+        .where(above.descendant_id == destination_id, below.ancestor_id.in_(folder_ids))
+    ))
+
+
+# moved folders and files that lie inside another moved folder, they travel along with it
+def get_nested_in_moved(db: Session, folder_ids: set[int], file_ids: set[int]) -> tuple[set[int], set[int]]:
+    if not folder_ids:
+        return set(), set()
+
+    subtree_ids = select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id.in_(folder_ids))
+
+    nested_folders = set(db.scalars(
+        select(FolderClosure.descendant_id)
+        .where(FolderClosure.ancestor_id.in_(folder_ids), FolderClosure.descendant_id.in_(folder_ids), FolderClosure.depth > 0)
+    ))
+
+    nested_files = set(db.scalars(
+        select(File.id).where(File.id.in_(file_ids), File.folder_id.in_(subtree_ids))
+    )) if file_ids else set()
+
+    return nested_folders, nested_files
+
+
+def bump_folder_versions(db: Session, folder_ids: list[int]) -> None:
+    db.execute(
+        update(Folder)
+        .where(Folder.id.in_(folder_ids))
+        .values(version=Folder.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# the listing also shows the breadcrumb, so the versions of every ancestor are part of the tag
+def get_folder_etag(user_id: int, folder_id: int, listing: FolderListing, db: Session) -> str:
+    rows = db.execute(
+        select(Folder.id, Folder.version, Folder.user_id, Folder.hidden)
+        .join(FolderClosure, FolderClosure.ancestor_id == Folder.id)
+        .where(FolderClosure.descendant_id == folder_id)
+        .order_by(FolderClosure.depth)
+    ).all()
+
+    # a folder under a deleted one is hidden as well
+    if not rows or rows[0].user_id != user_id or rows[0].hidden:
+        raise FolderNotFound("This folder does not exist.")
+
+    versions = [[row.id, row.version] for row in rows]
+    digest = hashlib.sha256(json.dumps([versions, listing.model_dump()]).encode("utf-8")).hexdigest()
+
+    return f'"{digest[:32]}"'
+
+
+def is_inside(db: Session, folder_id: int, ancestor_id: int) -> bool:
+    return db.scalar(
+        select(FolderClosure.depth).where(FolderClosure.ancestor_id == ancestor_id, FolderClosure.descendant_id == folder_id)
+    ) is not None
+
+
+# ancestors of a folder from the root down, without the folder itself
+def get_breadcrumbs(db: Session, folder_id: int) -> list[FolderMember]:
+    rows = db.execute(
+        select(Folder.id, Folder.name)
+        .join(FolderClosure, FolderClosure.ancestor_id == Folder.id)
+        .where(FolderClosure.descendant_id == folder_id, FolderClosure.depth > 0)
+        .order_by(FolderClosure.depth.desc())
+    ).all()
+
+    return [FolderMember(id=id, name=name) for id, name in rows]
+
+
+# rows of (id, parent_id, name, depth), parents always come before their children
+def get_subtree(db: Session, id: int) -> list[tuple[int, int, str, int]]:
+    return db.execute(
+        select(Folder.id, Folder.parent_id, Folder.name, FolderClosure.depth)
+        .join(FolderClosure, FolderClosure.descendant_id == Folder.id)
+        .where(FolderClosure.ancestor_id == id, Folder.hidden == False)
+        .order_by(FolderClosure.depth)
+    ).all()
+
+
+def subtree_folder_ids(folder_id: int):
+    return select(FolderClosure.descendant_id).where(FolderClosure.ancestor_id == folder_id)
+
+
+# the subtree disappears from every listing at once, its rows are removed by the deletion worker
+def hide_subtree(db: Session, folder_id: int) -> None:
+    db.execute(
+        update(Folder)
+        .where(Folder.id.in_(subtree_folder_ids(folder_id)))
+        .values(hidden=True)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# set whenever a deletion job is created, so the worker doesn't wait for its next round
+folder_deletion_wakeup = threading.Event()
+
+
+def notify_folder_deletion() -> None:
+    folder_deletion_wakeup.set()
+
+
+def delete_files_batch(job: FolderDeletionJob, db: Session) -> int:
+    files = db.execute(
+        select(File.id, File.name_in_storage, File.size)
+        .where(File.folder_id.in_(subtree_folder_ids(job.folder_id)))
+        .order_by(File.id)
+        .limit(settings.FOLDER_DELETION_BATCH)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    if not files:
+        return 0
+
+    file_ids = [file.id for file in files]
+
+    # the recipients of shared files are told when the files are actually removed
+    shared = db.execute(
+        select(SharedFile.file_id, SharedFile.destination_user_id).where(SharedFile.file_id.in_(file_ids))
+    ).all()
+
+    record_changes(db, [
+        change_row(user_id, ChangeEntity.SHARED_FILE, ChangeAction.DELETE, file_id, peer_user_id=job.user_id)
+        for file_id, user_id in shared
+    ])
+
+    db.execute(delete(SharedFile).where(SharedFile.file_id.in_(file_ids)))
+
+    # the objects are removed by the storage drainer once this is committed
+    enqueue_storage_deletion([file.name_in_storage for file in files], db)
+    release_user_space(job.user_id, sum(file.size for file in files), db)
+
+    db.execute(delete(File).where(File.id.in_(file_ids)))
+
+    job.files_deleted += len(files)
+    return len(files)
+
+
+# unfinished uploads into the subtree would keep its folders from being deleted
+def abort_upload_sessions_batch(job: FolderDeletionJob, db: Session) -> int:
+    sessions = db.query(UploadSession).filter(
+        UploadSession.folder_id.in_(subtree_folder_ids(job.folder_id))
+    ).limit(settings.FOLDER_DELETION_BATCH).all()
+
+    for session in sessions:
+        try:
+            abort_multipart_upload(session.name_in_storage, session.upload_id)
+        except FileDeletionError as e:
+            logger.debug(f"Could not abort upload session {session.id}: {str(e)}")
+
+        db.delete(session)
+
+    return len(sessions)
 
-            folder_ids = traverse_subfolders(db, folder.id)
-            logger.debug(f"Traversing subfolders for folder {folder.id}: {folder_ids}")
 
-            file_ids, file_names, file_sizes = get_files_for_folders(db, folder_ids)
+# the deepest folders go first, so a folder is never removed before its subfolders
+def delete_folders_batch(job: FolderDeletionJob, db: Session) -> int:
+    folder_ids = db.scalars(
+        select(FolderClosure.descendant_id)
+        .where(FolderClosure.ancestor_id == job.folder_id)
+        .order_by(FolderClosure.depth.desc())
+        .limit(settings.FOLDER_DELETION_BATCH)
+    ).all()
 
-            logger.debug(f"File ids: {file_ids}")
-            logger.debug(f"File names: {file_names}")
-            logger.debug(f"File sizes: {file_sizes}")
+    if not folder_ids:
+        return 0
 
-            if file_names:
-                bulk_remove_from_storage(file_names)
+    db.execute(delete(FolderClosure).where(FolderClosure.descendant_id.in_(folder_ids)))
+    db.execute(delete(Folder).where(Folder.id.in_(folder_ids)).execution_options(synchronize_session=False))
 
-            total_size_to_decrement = sum(file_sizes)
-            logger.debug(f"Total size to decrement: {total_size_to_decrement}")
+    job.folders_deleted += len(folder_ids)
+    return len(folder_ids)
 
-            decrement_user_space(folder.user_id, total_size_to_decrement, db)
 
-            db.query(SharedFile).filter(SharedFile.file_id.in_(file_ids)).delete()
+# runs one bounded batch of the oldest pending job in its own transaction, returns False if there was nothing to do
+def run_folder_deletion_batch() -> bool:
+    db = next(get_db())
 
-            db.query(File).filter(File.id.in_(file_ids)).delete()
+    try:
+        # jobs locked by a worker of another process are skipped
+        job = db.query(FolderDeletionJob).filter(
+            FolderDeletionJob.status == "pending"
+        ).order_by(FolderDeletionJob.created_at).limit(1).with_for_update(skip_locked=True).first()
+
+        if not job:
+            return False
 
-            db.query(Folder).filter(Folder.id.in_(folder_ids)).delete()
+        now = datetime.utcnow()
+        deleted = delete_files_batch(job, db) or abort_upload_sessions_batch(job, db) or delete_folders_batch(job, db)
 
-            db.delete(folder)
+        job.updated_at = now
+        if not deleted:
+            job.status = "done"
+            job.finished_at = now
+            logger.debug(f"Folder deletion {job.id} finished: {job.files_deleted} files, {job.folders_deleted} folders")
 
-            db.commit()
+        db.commit()
+        notify_storage_deletion()
 
+        return True
     except Exception as e:
         db.rollback()
         raise e
+    finally:
+        db.close()
+
+
+def folder_deletion_task():
+    while True:
+        try:
+            while run_folder_deletion_batch():
+                pass
+        except Exception as e:
+            logger.debug(f"Folder deletion worker failed: {str(e)}")
+
+        # also picks up the jobs left unfinished by a restart
+        folder_deletion_wakeup.wait(settings.FOLDER_DELETION_INTERVAL_SECONDS)
+        folder_deletion_wakeup.clear()
+
+
+def initiate_folder_deletion_task():
+    logger.debug("Starting a thread to delete folders in the background...")
+    task_thread = threading.Thread(target=folder_deletion_task)
+    task_thread.daemon = True
+    task_thread.start()
+
+
+def get_file_rows_for_folders(db: Session, folder_ids: list[int]) -> list:
+    return db.execute(
+        select(
+            File.id, File.folder_id, File.name, File.type, File.format,
+            File.encrypted_key, File.encrypted_iv, File.name_in_storage, File.size
+        ).where(File.folder_id.in_(folder_ids))
+    ).all()
+
+
+def copy_folder_rows(
+    db: Session, 
+    user_id: int, 
+    subtree: list[tuple[int, int, str, int]], 
+    parent_id: int, 
+    name: str) -> dict[int, int]:
+    id_mapping = {}
+    levels: dict[int, list[tuple[int, int, str, int]]] = {}
+
+    for row in subtree:
+        levels.setdefault(row[3], []).append(row)
+
+    # one multi-row insert per level, the new parents are known once the previous level is inserted
+    for depth in sorted(levels):
+        rows = levels[depth]
+        new_ids = db.execute(
+            insert(Folder).returning(Folder.id, sort_by_parameter_order=True),
+            [
+                {
+                    "user_id": user_id,
+                    "parent_id": parent_id if depth == 0 else id_mapping[row[1]],
+                    "name": name if depth == 0 else row[2]
+                }
+                for row in rows
+            ]
+        ).scalars().all()
+
+        id_mapping.update({row[0]: new_id for row, new_id in zip(rows, new_ids)})
+
+    return id_mapping
+
+
+# names are user input, they must not be able to escape the archive when extracted
+def archive_name(name: str) -> str:
+    name = name.replace("/", "_").replace("\\", "_")
+    return "_" if name in (".", "..", "") else name
+
+
+# sanitized names can collide (e.g. "a/b" and "a_b"), the later one gets a numeric suffix instead of overwriting on extraction
+def unique_path(path: str, taken: set[str]) -> str:
+    candidate = path
+    suffix = 1
+
+    while candidate in taken:
+        candidate = f"{path} ({suffix})"
+        suffix += 1
+
+    taken.add(candidate)
+    return candidate
+
+
+# archive paths of every folder in the subtree, relative to the archived folder's parent
+def build_folder_paths(subtree: list[tuple[int, int, str, int]], taken: set[str]) -> dict[int, str]:
+    paths = {}
+
+    for id, parent_id, name, depth in subtree:
+        name = archive_name(name)
+        paths[id] = unique_path(name if depth == 0 else f"{paths[parent_id]}/{name}", taken)
+
+    return paths
+
+
+def tar_header(path: str, size: int) -> bytes:
+    info = tarfile.TarInfo(path)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(datetime.utcnow().timestamp())
+
+    return info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8")
+
+
+def tar_padding(size: int) -> bytes:
+    return b"\0" * ((tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE)
+
+
+class FolderArchive:
+    """
+    Tar archive of a folder subtree, produced while it is being sent.
+    The first member is a manifest with the metadata (including key/iv) of every file,
+    then the ciphertexts follow. Up to ARCHIVE_READ_AHEAD objects are requested from
+    the storage in advance, their bodies are only read when it's their turn.
+    """
+
+    def __init__(self, subtree: list[tuple[int, int, str, int]], files: list):
+        taken = {"manifest.json"}
+        self.paths = build_folder_paths(subtree, taken)
+        self.files = files
+        # decided up front, the manifest and the members have to agree
+        self.file_paths = {
+            file.id: unique_path(f"{self.paths[file.folder_id]}/{archive_name(file.name)}", taken) for file in files
+        }
+        self._executor = ThreadPoolExecutor(max_workers=settings.ARCHIVE_READ_AHEAD)
+        self._pending: deque[Future] = deque()
+
+    def member_path(self, file) -> str:
+        return self.file_paths[file.id]
+
+    def manifest(self) -> bytes:
+        return json.dumps([
+            {
+                "id": file.id,
+                "path": self.member_path(file),
+                "name": file.name,
+                "type": file.type,
+                "format": file.format,
+                "encrypted_key": file.encrypted_key,
+                "encrypted_iv": file.encrypted_iv
+            }
+            for file in self.files
+        ]).encode("utf-8")
+
+    def __iter__(self):
+        try:
+            manifest = self.manifest()
+            yield tar_header("manifest.json", len(manifest)) + manifest + tar_padding(len(manifest))
+
+            upcoming = iter(self.files)
+
+            for file in upcoming:
+                self._pending.append(self._executor.submit(open_storage_stream, file.name_in_storage))
+                if len(self._pending) >= settings.ARCHIVE_READ_AHEAD:
+                    break
+
+            for file in self.files:
+                stream: StorageStream = self._pending.popleft().result()
+
+                next_file = next(upcoming, None)
+                if next_file is not None:
+                    self._pending.append(self._executor.submit(open_storage_stream, next_file.name_in_storage))
+
+                yield tar_header(self.member_path(file), stream.size)
+                yield from stream
+                yield tar_padding(stream.size)
+
+            # end-of-archive marker
+            yield b"\0" * (2 * tarfile.BLOCKSIZE)
+        finally:
+            self.close()
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return iterate_in_storage_pool(iter(self))
+
+    def close(self) -> None:
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.cancel() and not future.exception():
+                future.result().close()
+        
+        self._executor.shutdown(wait=False)
+
+
+class FolderTree:
+    """
+    The user's whole hierarchy as NDJSON: a header line with the counts and the change feed
+    cursor the snapshot is consistent with, then one line
+    per folder (parents before their children) and one line per file.
+    Rows are loaded up front as plain tuples, the lines are encoded while being sent.
+    """
+
+    def __init__(self, root_id: int, cursor: str, folders: list, files: list):
+        self.root_id = root_id
+        self.cursor = cursor
+        self.folders = folders
+        self.files = files
+
+    def lines(self):
+        yield {"kind": "tree", "root_id": self.root_id, "cursor": self.cursor, "folders": len(self.folders), "files": len(self.files)}
+
+        for id, parent_id, name in self.folders:
+            yield {"kind": "folder", "id": id, "parent_id": parent_id, "name": name}
+
+        for id, folder_id, name, type, format, size in self.files:
+            yield {"kind": "file", "id": id, "folder_id": folder_id, "name": name, "type": type, "format": format, "size": size}
+
+    def __iter__(self):
+        batch = []
+
+        for line in self.lines():
+            batch.append(json.dumps(line, separators=(",", ":")))
+
+            if len(batch) >= settings.TREE_LINES_PER_CHUNK:
+                yield ("\n".join(batch) + "\n").encode("utf-8")
+                batch = []
+
+        if batch:
+            yield ("\n".join(batch) + "\n").encode("utf-8")
+
+
+def get_folder_tree_rows(user_id: int, root_id: int, db: Session) -> tuple[list, list]:
+    folders = db.execute(
+        select(Folder.id, Folder.parent_id, Folder.name)
+        .join(FolderClosure, FolderClosure.descendant_id == Folder.id)
+        .where(FolderClosure.ancestor_id == root_id, Folder.hidden == False)
+        .order_by(FolderClosure.depth, Folder.id)
+    ).all()
+
+    files = db.execute(
+        select(File.id, File.folder_id, File.name, File.type, File.format, File.size)
+        .join(Folder, Folder.id == File.folder_id)
+        .where(Folder.user_id == user_id, Folder.hidden == False)
+        .order_by(File.folder_id, File.id)
+    ).all()
+
+    return folders, files
 
 
 def get_root(user_id: int, db: Session) -> Folder:
@@ -93,7 +555,7 @@ def get_root(user_id: int, db: Session) -> Folder:
 
 
 def get_folder(user_id: int, folder_id: int, db: Session) -> Folder:
-    folder = db.query(Folder).filter(Folder.id == folder_id, Folder.user_id == user_id).first()
+    folder = db.query(Folder).filter(Folder.id == folder_id, Folder.user_id == user_id, Folder.hidden == False).first()
 
     if not folder:
         raise FolderNotFound("This folder does not exist.")
@@ -101,19 +563,156 @@ def get_folder(user_id: int, folder_id: int, db: Session) -> Folder:
     return folder
 
 
+# rows of (id, parent_id, name), every requested folder has to exist and belong to the user
+def get_folders_to_move(user_id: int, folder_ids: set[int], db: Session) -> list:
+    if not folder_ids:
+        return []
+
+    rows = db.execute(
+        select(Folder.id, Folder.parent_id, Folder.name)
+        .where(Folder.id.in_(folder_ids), Folder.user_id == user_id, Folder.hidden == False)
+    ).all()
+
+    if len(rows) != len(folder_ids):
+        raise FolderNotFound("Some of the folders do not exist.")
+
+    return rows
+
+
+# rows of (id, folder_id, name), every requested file has to exist and belong to the user
+def get_files_to_move(user_id: int, file_ids: set[int], db: Session) -> list:
+    if not file_ids:
+        return []
+
+    rows = db.execute(
+        select(File.id, File.folder_id, File.name)
+        .join(Folder, Folder.id == File.folder_id)
+        .where(File.id.in_(file_ids), Folder.user_id == user_id, Folder.hidden == False)
+    ).all()
+
+    if len(rows) != len(file_ids):
+        raise FileDoesNotExist("Some of the files do not exist.")
+
+    return rows
+
+
+# moved folders may keep their names if they already are in the destination, but can't take each other's
+def folder_names_taken(user_id: int, names: list[str], folder_ids: set[int], parent_id: int, db: Session) -> bool:
+    if len(set(names)) != len(names):
+        return True
+
+    return db.scalar(
+        select(Folder.id)
+        .where(Folder.parent_id == parent_id, Folder.user_id == user_id, Folder.hidden == False, Folder.name.in_(names), Folder.id.not_in(folder_ids))
+        .limit(1)
+    ) is not None
+
+
+def file_names_taken(names: list[str], file_ids: set[int], folder_id: int, db: Session) -> bool:
+    if len(set(names)) != len(names):
+        return True
+
+    return db.scalar(
+        select(File.id).where(File.folder_id == folder_id, File.name.in_(names), File.id.not_in(file_ids)).limit(1)
+    ) is not None
+
+
 def folder_exists_in_parent(user_id: int, folder_name: str, folder_id: int, db: Session) -> bool:
     exists = db.query(Folder).filter(
         Folder.name == folder_name, 
         Folder.parent_id == folder_id, 
-        Folder.user_id == user_id).first()
+        Folder.user_id == user_id,
+        Folder.hidden == False).first()
     
     return True if exists else False
 
 
-def construct_model(folder) -> FolderOut:
+FILE_SORT_COLUMNS = {"name": File.name, "type": File.type, "size": File.size, "id": File.id}
+
+
+# the cursor points past the last returned entry: ["folder" | "file", sort, sort value, id]
+def encode_cursor(kind: str, sort: str, key, id: int | None) -> str:
+    return base64.urlsafe_b64encode(json.dumps([kind, sort, key, id]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple[str, object, int | None]:
+    try:
+        kind, cursor_sort, key, id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise InvalidCursor("This cursor is invalid.")
+
+    # a file cursor without an id points at the start of the files
+    if kind not in ("folder", "file") or not (isinstance(id, int) or (kind == "file" and id is None)):
+        raise InvalidCursor("This cursor is invalid.")
+
+    if cursor_sort != sort:
+        raise InvalidCursor("This cursor belongs to a listing with a different sort order.")
+
+    return kind, key, id
+
+
+def keyset_page(db: Session, columns: list, parent_filter, sort_column, id_column, listing: FolderListing, after, limit: int) -> list:
+    query = select(*columns).where(parent_filter)
+
+    if after is not None:
+        position = tuple_(sort_column, id_column)
+        query = query.where(position < after if listing.desc else position > after)
+
+    if listing.desc:
+        query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(sort_column, id_column)
+
+    return db.execute(query.limit(limit)).all()
+
+
+# subfolders come first, then files; only one page of each is loaded
+def construct_model(folder, db: Session, listing: FolderListing = FolderListing()) -> FolderOut:
+    kind, key, last_id = decode_cursor(listing.cursor, listing.sort) if listing.cursor else ("folder", None, None)
+
+    visible = and_(Folder.parent_id == folder.id, Folder.hidden == False)
+
+    folders_total = db.scalar(select(func.count()).select_from(Folder).where(visible))
+    files_total = db.scalar(select(func.count()).select_from(File).where(File.folder_id == folder.id))
+
+    # folders have no type or size, they are listed by name unless sorted by id
+    folder_sort = Folder.id if listing.sort == "id" else Folder.name
+    file_sort = FILE_SORT_COLUMNS[listing.sort]
+
+    folders, files, next_cursor = [], [], None
+
+    if kind == "folder":
+        folders = keyset_page(
+            db, [Folder.id, Folder.name, folder_sort], visible, folder_sort, Folder.id,
+            listing, None if last_id is None else (key, last_id), listing.limit + 1
+        )
+
+        if len(folders) > listing.limit:
+            folders = folders[:listing.limit]
+            next_cursor = encode_cursor("folder", listing.sort, folders[-1][2], folders[-1][0])
+        kind, key, last_id = "file", None, None
+
+    remaining = listing.limit - len(folders)
+
+    if next_cursor is None and remaining > 0:
+        files = keyset_page(
+            db, [File.id, File.name, File.type, File.format, file_sort], File.folder_id == folder.id, file_sort, File.id,
+            listing, None if last_id is None else (key, last_id), remaining + 1
+        )
+
+        if len(files) > remaining:
+            files = files[:remaining]
+            next_cursor = encode_cursor("file", listing.sort, files[-1][4], files[-1][0])
+    elif next_cursor is None and files_total:
+        next_cursor = encode_cursor("file", listing.sort, None, None)
+
     return FolderOut(
         id=folder.id,
         name=folder.name,
-        folders=[FolderMember(id=f.id, name=f.name) for f in folder.subfolders],
-        files=[FileOut(id=f.id, name=f.name, type=f.type, format=f.format) for f in folder.files]
+        path=get_breadcrumbs(db, folder.id),
+        folders=[FolderMember(id=f.id, name=f.name) for f in folders],
+        files=[FileOut(id=f.id, name=f.name, type=f.type, format=f.format) for f in files],
+        folders_total=folders_total,
+        files_total=files_total,
+        next_cursor=next_cursor
     )
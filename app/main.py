@@ -3,33 +3,51 @@ settings = Settings()
 
 from fastapi import FastAPI, Request, status
 from app.database import engine, Base, get_db
+from app.models import create_missing_indexes
 from app.auth.routes import auth_router
 from app.folders.routes import folder_router
 from app.files.routes import file_router
 from app.users.routes import user_router
 from app.settings.routes import settings_router
 from app.payments.routes import payment_router
+from app.storage.routes import storage_router
+from app.sync.routes import sync_router
 from fastapi.middleware.cors import CORSMiddleware
+from app.middleware import AdmissionMiddleware, create_route_classes, ROUTE_RULES
 from fastapi.responses import JSONResponse
 from loguru import logger
 from contextlib import asynccontextmanager
 from app.payments.utils import init_subscription_types, initiate_subscription_task
+from app.files.utils import initiate_upload_session_task, initiate_storage_deletion_task
+from app.files.reconciliation import initiate_reconciliation_task
+from app.auth.utils import shutdown_hashing_pool
+from app.folders.utils import init_folder_closure, initiate_folder_deletion_task
+from app.sync.utils import initiate_change_journal_task
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     Base.metadata.create_all(bind=engine)
+    create_missing_indexes(engine)
     
     db_gen = get_db()
     db = next(db_gen)
     try:
         init_subscription_types(db)
+        init_folder_closure(db)
         initiate_subscription_task()
+        initiate_upload_session_task()
+        initiate_storage_deletion_task()
+        initiate_reconciliation_task()
+        initiate_change_journal_task()
+        initiate_folder_deletion_task()
     finally:
         db_gen.close()
 
     yield
 
+    shutdown_hashing_pool()
+
 
 app = FastAPI(lifespan=lifespan)
 
@@ -40,6 +58,16 @@ async def global_exception_handler(request: Request, exc: Exception):
     return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"detail": "Unexpected error."})
 
 
+# added before CORS so that rejected requests still carry the CORS headers
+app.add_middleware(
+    AdmissionMiddleware,
+    classes=create_route_classes(settings),
+    rules=ROUTE_RULES,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    retry_after=settings.ADMISSION_RETRY_AFTER_SECONDS
+)
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -55,3 +83,5 @@ app.include_router(file_router, prefix="/files")
 app.include_router(user_router, prefix="/users")
 app.include_router(settings_router, prefix="/settings")
 app.include_router(payment_router, prefix="/payments")
+app.include_router(storage_router, prefix="/storage")
+app.include_router(sync_router, prefix="/sync")
@@ -0,0 +1,168 @@
+from starlette.types import ASGIApp, Scope, Receive, Send
+from starlette.responses import JSONResponse
+from fastapi import status
+from collections import OrderedDict
+from typing import Optional
+from loguru import logger
+import anyio
+import math
+import time
+import re
+
+
+class TokenBuckets:
+    """Per-client token buckets, the least recently seen clients are forgotten first."""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_clients: int):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    # returns how many seconds the client has to wait, 0 if the request may pass
+    def take(self, client: str) -> float:
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0.0
+        else:
+            wait = (1 - tokens) / self.rate
+
+        self.buckets[client] = (tokens, now)
+        while len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+
+        return wait
+
+
+class RouteClass:
+    def __init__(self, name: str, concurrency: int, queue: int, rate_per_minute: float, burst: int, max_clients: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.waiting = 0
+        self.buckets = TokenBuckets(rate_per_minute, burst, max_clients) if rate_per_minute > 0 else None
+        self._semaphore: Optional[anyio.Semaphore] = None
+
+    # created on first use so that it belongs to the running event loop
+    def get_semaphore(self) -> Optional[anyio.Semaphore]:
+        if self.concurrency <= 0:
+            return None
+        if self._semaphore is None:
+            self._semaphore = anyio.Semaphore(self.concurrency)
+        return self._semaphore
+
+
+class AdmissionMiddleware:
+    """Sheds load before it reaches the routes.
+
+    Requests are split into classes (transfers, auth, webhooks and everything else as metadata),
+    each with its own concurrency limit and wait queue, so heavy transfers can't starve cheap calls.
+    A request that finds the queue full, or waits longer than queue_timeout, gets 503 with Retry-After.
+    Clients that exceed their class's token bucket get 429.
+    """
+
+    def __init__(self, app: ASGIApp, classes: dict[str, RouteClass], rules: list[tuple[str, str, str]], queue_timeout: float, retry_after: int):
+        self.app = app
+        self.classes = classes
+        self.rules = [(method, re.compile(pattern), name) for method, pattern, name in rules]
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+    def classify(self, method: str, path: str) -> RouteClass:
+        for rule_method, pattern, name in self.rules:
+            if rule_method == method and pattern.fullmatch(path):
+                return self.classes[name]
+        return self.classes["metadata"]
+
+    async def reject(self, scope: Scope, receive: Receive, send: Send, status_code: int, detail: str, retry_after: int) -> None:
+        response = JSONResponse(status_code=status_code, content={"detail": detail}, headers={"Retry-After": str(retry_after)})
+        await response(scope, receive, send)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        route_class = self.classify(scope["method"], scope["path"])
+
+        if route_class.buckets is not None:
+            client = scope["client"][0] if scope.get("client") else "unknown"
+            wait = route_class.buckets.take(client)
+            if wait > 0:
+                await self.reject(scope, receive, send, status.HTTP_429_TOO_MANY_REQUESTS, "Too many requests.", math.ceil(wait))
+                return
+
+        semaphore = route_class.get_semaphore()
+        if semaphore is None:
+            await self.app(scope, receive, send)
+            return
+
+        if semaphore.value == 0 and route_class.waiting >= route_class.queue:
+            logger.debug(f"Shedding a '{route_class.name}' request, the queue is full")
+            await self.reject(scope, receive, send, status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy. Try again later.", self.retry_after)
+            return
+
+        route_class.waiting += 1
+        try:
+            with anyio.fail_after(self.queue_timeout):
+                await semaphore.acquire()
+        except TimeoutError:
+            logger.debug(f"Shedding a '{route_class.name}' request, it waited too long")
+            await self.reject(scope, receive, send, status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy. Try again later.", self.retry_after)
+            return
+        finally:
+            route_class.waiting -= 1
+
+        # the slot is held until the response, including a streamed body, is sent
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            semaphore.release()
+
+
+ROUTE_RULES = [
+    ("POST", r"/files/?", "transfer"),
+    ("POST", r"/files/batch", "transfer"),
+    ("POST", r"/files/stream", "transfer"),
+    ("PUT", r"/files/sessions/[^/]+/parts/\d+", "transfer"),
+    ("GET", r"/files/\d+", "transfer"),
+    ("POST", r"/files/\d+/copy", "transfer"),
+    ("GET", r"/folders/\d+/archive", "transfer"),
+    ("GET", r"/folders/tree", "transfer"),
+    ("POST", r"/folders/\d+/copy", "transfer"),
+    ("POST", r"/auth/login", "auth"),
+    ("POST", r"/auth/register", "auth"),
+    ("GET", r"/auth/login/challenge/.+", "auth"),
+    ("POST", r"/auth/login/challenge/.+", "auth"),
+    ("PATCH", r"/settings/username", "auth"),
+    ("PATCH", r"/settings/password", "auth"),
+    ("POST", r"/payments/webhook", "webhook"),
+]
+
+
+def create_route_classes(settings) -> dict[str, RouteClass]:
+    max_clients = settings.RATE_LIMIT_MAX_CLIENTS
+
+    return {
+        "transfer": RouteClass(
+            "transfer", settings.ADMISSION_TRANSFER_CONCURRENCY, settings.ADMISSION_TRANSFER_QUEUE,
+            settings.RATE_LIMIT_TRANSFER_PER_MINUTE, settings.RATE_LIMIT_TRANSFER_BURST, max_clients
+        ),
+        "auth": RouteClass(
+            "auth", settings.ADMISSION_AUTH_CONCURRENCY, settings.ADMISSION_AUTH_QUEUE,
+            settings.RATE_LIMIT_AUTH_PER_MINUTE, settings.RATE_LIMIT_AUTH_BURST, max_clients
+        ),
+        "metadata": RouteClass(
+            "metadata", settings.ADMISSION_METADATA_CONCURRENCY, settings.ADMISSION_METADATA_QUEUE,
+            settings.RATE_LIMIT_METADATA_PER_MINUTE, settings.RATE_LIMIT_METADATA_BURST, max_clients
+        ),
+        # webhooks come from the payment provider's few addresses, so they aren't rate limited per client
+        "webhook": RouteClass(
+            "webhook", settings.ADMISSION_WEBHOOK_CONCURRENCY, settings.ADMISSION_WEBHOOK_QUEUE,
+            0, 0, max_clients
+        ),
+    }
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Boolean, Float, BigInteger, Index
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import false
 from app.database import Base
 from datetime import datetime
 
@@ -43,24 +43,12 @@ class User(Base):
     subscription_type_id = Column(Integer, ForeignKey('subscription_types.id'), default=1)
     stripe_customer_id = Column(String, default="")
 
-    challenges = relationship("Challenge", back_populates="user")
     folders = relationship("Folder", back_populates="user")
 
     subscription_type = relationship("SubscriptionType", uselist=False)
     subscription = relationship("Subscription", back_populates="user", uselist=False)
 
 
-class Challenge(Base):
-    __tablename__ = "challenges"
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
-    created_at = Column(DateTime, default=func.now())
-    random_chars = Column(String(20))
-    is_used = Column(Boolean, default=False)
-
-    user = relationship("User", back_populates="challenges")
-
-
 class Folder(Base):
     __tablename__ = 'folders'
     
@@ -68,6 +56,10 @@ class Folder(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     parent_id = Column(Integer, ForeignKey('folders.id'), nullable=True)
     name = Column(String, nullable=False)
+    # bumped whenever the folder's own name or any of its direct children change, used for ETags
+    version = Column(Integer, nullable=False, default=0, server_default="0")
+    # set on the whole subtree as soon as its deletion is requested, the rows are removed later in batches
+    hidden = Column(Boolean, nullable=False, default=False, server_default=false())
 
     
     user = relationship('User', back_populates='folders')
@@ -76,6 +68,36 @@ class Folder(Base):
     files = relationship('File', back_populates='folder')
 
 
+# folder listings are paginated by (sort column, id) within a parent
+ix_folders_parent_name = Index('ix_folders_parent_name', Folder.parent_id, Folder.name, Folder.id)
+ix_folders_parent_id = Index('ix_folders_parent_id', Folder.parent_id, Folder.id)
+
+
+# every (ancestor, descendant) pair of the folder tree, including each folder with itself at depth 0
+class FolderClosure(Base):
+    __tablename__ = 'folder_closure'
+
+    ancestor_id = Column(Integer, ForeignKey('folders.id'), primary_key=True)
+    descendant_id = Column(Integer, ForeignKey('folders.id'), primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
+
+
+# a folder subtree being deleted in the background, survives restarts of the worker
+class FolderDeletionJob(Base):
+    __tablename__ = 'folder_deletion_jobs'
+
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    folder_id = Column(Integer, nullable=False)
+    parent_id = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default="pending", index=True)
+    files_deleted = Column(Integer, nullable=False, default=0)
+    folders_deleted = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
 class File(Base):
     __tablename__ = 'files'
     
@@ -92,6 +114,83 @@ class File(Base):
     folder = relationship('Folder', back_populates='files')
 
 
+ix_files_folder_name = Index('ix_files_folder_name', File.folder_id, File.name, File.id)
+ix_files_folder_type = Index('ix_files_folder_type', File.folder_id, File.type, File.id)
+ix_files_folder_size = Index('ix_files_folder_size', File.folder_id, File.size, File.id)
+ix_files_folder_id = Index('ix_files_folder_id', File.folder_id, File.id)
+ix_files_name_in_storage = Index('ix_files_name_in_storage', File.name_in_storage)
+
+# the reconciliation walks the names in byte order, the same order the storage lists them in
+ix_files_name_in_storage_bytes = Index(
+    'ix_files_name_in_storage_bytes', File.name_in_storage.collate("C")
+).ddl_if(dialect="postgresql")
+
+
+class UploadSession(Base):
+    __tablename__ = 'upload_sessions'
+
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    folder_id = Column(Integer, ForeignKey('folders.id'), nullable=False)
+    name = Column(String, nullable=False)
+    format = Column(String, nullable=False)
+    type = Column(String, nullable=False)
+    encrypted_key = Column(String, nullable=False)
+    encrypted_iv = Column(String, nullable=False)
+    name_in_storage = Column(String, nullable=False)
+    upload_id = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+    parts = relationship('UploadPart', back_populates='session', order_by='UploadPart.part_number', cascade='all, delete-orphan')
+
+
+class UploadPart(Base):
+    __tablename__ = 'upload_parts'
+
+    session_id = Column(String, ForeignKey('upload_sessions.id'), primary_key=True)
+    part_number = Column(Integer, primary_key=True)
+    etag = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+
+    session = relationship('UploadSession', back_populates='parts')
+
+
+# objects waiting to be removed from the storage, written in the same transaction as the metadata change;
+# rows that ran out of attempts are kept with no next_attempt_at, so that they can be looked into
+class StorageDeletion(Base):
+    __tablename__ = 'storage_deletions'
+
+    id = Column(Integer, primary_key=True)
+    name_in_storage = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+ix_storage_deletions_name_in_storage = Index('ix_storage_deletions_name_in_storage', StorageDeletion.name_in_storage)
+
+
+# append-only journal of what changed for a user, written in the same transaction as the change itself
+class ChangeEvent(Base):
+    __tablename__ = 'change_events'
+
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    entity = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String, nullable=False)
+    parent_id = Column(Integer, nullable=True)
+    name = Column(String, nullable=True)
+    peer_user_id = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+Index('ix_change_events_user_id', ChangeEvent.user_id, ChangeEvent.id)
+Index('ix_change_events_entity', ChangeEvent.user_id, ChangeEvent.entity, ChangeEvent.entity_id, ChangeEvent.id)
+
+
 class SharedFile(Base):
     __tablename__ = 'shared_files'
 
@@ -106,3 +205,17 @@ class SharedFile(Base):
     
     destination_user = relationship('User', foreign_keys=[destination_user_id], backref='received_files')
     initiator_user = relationship('User', foreign_keys=[initiator_user_id], backref='shared_files_as_initiator')
+
+
+# create_all skips tables that already exist, so indexes added to existing tables later are created at startup
+INDEXES_ON_EXISTING_TABLES = [
+    ix_folders_parent_name, ix_folders_parent_id,
+    ix_files_folder_name, ix_files_folder_type, ix_files_folder_size, ix_files_folder_id,
+    ix_files_name_in_storage, ix_files_name_in_storage_bytes,
+    ix_storage_deletions_name_in_storage,
+]
+
+
+def create_missing_indexes(engine) -> None:
+    for index in INDEXES_ON_EXISTING_TABLES:
+        index.create(engine, checkfirst=True)
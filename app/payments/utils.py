@@ -2,6 +2,7 @@ from loguru import logger
 from app.models import SubscriptionType
 from sqlalchemy import func, select, update, delete
 from app.auth.schemas import CurrentUser
+from app.auth.utils import profile_cache, invalidate_user_profile
 from sqlalchemy.orm import Session
 from app.models import User, Subscription
 from app.main import settings
@@ -42,6 +43,9 @@ def remove_expired_subscriptions():
     db.commit()
     db.close()
 
+    # the expired users aren't known one by one here, so every cached profile is dropped
+    profile_cache.clear()
+
 
 def periodic_task():
     schedule.every(1).minutes.do(remove_expired_subscriptions)
@@ -92,6 +96,7 @@ def handle_successful_payment(event, db: Session) -> None:
     user.subscription_type_id = subscription_type.id
 
     db.commit()
+    invalidate_user_profile(user.id)
 
 
 def try_construct_event(payload, sig_header):
@@ -125,6 +130,7 @@ def update_customer_id(db: Session, user_id: int, customer_id: str) -> None:
     user = db.query(User).filter(User.id == user_id).first()
     user.stripe_customer_id = customer_id
     db.flush()
+    invalidate_user_profile(user_id)
 
 
 def create_stripe_customer(user: CurrentUser) -> str:
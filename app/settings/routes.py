@@ -6,6 +6,7 @@ from app.auth.schemas import CurrentUser
 from app.settings.schemas import UsernamePatch, PasswordPatch
 from app.settings.services import try_patch_username, try_patch_password
 from app.settings.errors import UsernameAlreadyExists, InvalidOldPassword
+from app.auth.errors import PasswordHashingBusy
 
 
 settings_router = APIRouter()
@@ -23,6 +24,8 @@ def patch_username(
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
     except InvalidOldPassword as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
+    except PasswordHashingBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
 
 
 @settings_router.patch("/password")
@@ -35,4 +38,6 @@ def patch_password(
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except InvalidOldPassword as e:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
+    except PasswordHashingBusy as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e), headers={"Retry-After": "1"})
 
@@ -1,6 +1,6 @@
 from sqlalchemy.orm import Session
 from app.models import User
-from app.auth.utils import hash_password, verify_password
+from app.auth.utils import hash_password, verify_password, invalidate_user_profile
 from app.auth.schemas import CurrentUser
 from app.settings.schemas import UsernamePatch, PasswordPatch
 from app.settings.errors import UsernameAlreadyExists, InvalidOldPassword
@@ -18,6 +18,7 @@ def try_patch_username(patch: UsernamePatch, current_user: CurrentUser, db: Sess
     
     user.username = patch.username
     db.commit()
+    invalidate_user_profile(user.id)
 
 
 def try_patch_password(patch: PasswordPatch, current_user: CurrentUser, db: Session) -> None:
@@ -27,4 +28,5 @@ def try_patch_password(patch: PasswordPatch, current_user: CurrentUser, db: Sess
         raise InvalidOldPassword("Invalid old password.")
     
     user.hashed_password = hash_password(patch.password)
-    db.commit()
\ No newline at end of file
+    db.commit()
+    invalidate_user_profile(user.id)
\ No newline at end of file
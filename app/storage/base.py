@@ -0,0 +1,99 @@
+from abc import ABC, abstractmethod
+from datetime import timedelta, datetime
+from typing import BinaryIO, Iterator, NamedTuple
+from app.storage.errors import OperationNotSupported
+from app.storage.schemas import StorageStats
+
+
+class ObjectStat(NamedTuple):
+    size: int
+    etag: str
+
+
+class StoredObject(NamedTuple):
+    name: str
+    size: int
+    last_modified: datetime
+
+
+class ObjectReader(ABC):
+    """
+    Body of a stored object, iterated in chunks. size and etag describe the whole object.
+    close() has to be called even if the body wasn't read to the end.
+    """
+
+    size: int
+    etag: str
+
+    @abstractmethod
+    def stream(self, chunk_size: int) -> Iterator[bytes]:
+        ...
+
+    @abstractmethod
+    def close(self) -> None:
+        ...
+
+
+class StorageBackend(ABC):
+    """
+    Operations the application needs from the object storage.
+    Every method is blocking and raises StorageError (or a subclass) on failure.
+    """
+
+    @abstractmethod
+    def put(self, name: str, stream: BinaryIO, length: int) -> None:
+        ...
+
+    # length == 0 means up to the end of the object
+    @abstractmethod
+    def open(self, name: str, offset: int = 0, length: int = 0) -> ObjectReader:
+        ...
+
+    @abstractmethod
+    def stat(self, name: str) -> ObjectStat:
+        ...
+
+    # removing a missing object is not an error
+    @abstractmethod
+    def delete(self, name: str) -> None:
+        ...
+
+    # returns the names that could not be removed
+    @abstractmethod
+    def bulk_delete(self, names: list[str]) -> list[str]:
+        ...
+
+    @abstractmethod
+    def copy(self, source: str, target: str) -> None:
+        ...
+
+    # every object in byte order of the names, fetched lazily page by page
+    @abstractmethod
+    def iter_objects(self) -> Iterator[StoredObject]:
+        ...
+
+    @abstractmethod
+    def create_multipart(self, name: str) -> str:
+        ...
+
+    @abstractmethod
+    def upload_part(self, name: str, upload_id: str, part_number: int, data: bytes) -> str:
+        ...
+
+    @abstractmethod
+    def complete_multipart(self, name: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        ...
+
+    @abstractmethod
+    def abort_multipart(self, name: str, upload_id: str) -> None:
+        ...
+
+    # only backends reachable by the clients themselves can hand out urls
+    def presign_put(self, name: str, expires: timedelta) -> str:
+        raise OperationNotSupported("This storage backend does not support presigned urls.")
+
+    def presign_get(self, name: str, expires: timedelta) -> str:
+        raise OperationNotSupported("This storage backend does not support presigned urls.")
+
+    def stats(self) -> StorageStats:
+        raise OperationNotSupported("This storage backend does not collect statistics.")
@@ -0,0 +1,14 @@
+class StorageError(Exception):
+    pass
+
+class ObjectNotFound(StorageError):
+    pass
+
+class UploadNotFound(StorageError):
+    pass
+
+class OperationNotSupported(StorageError):
+    pass
+
+class StorageSaturated(StorageError):
+    pass
@@ -0,0 +1,250 @@
+from typing import BinaryIO, Iterator
+from urllib.parse import quote, unquote
+from datetime import datetime, timezone
+from loguru import logger
+from app.storage.base import StorageBackend, ObjectReader, ObjectStat, StoredObject
+from app.storage.errors import StorageError, ObjectNotFound, UploadNotFound
+import hashlib
+import shutil
+import mmap
+import uuid
+import os
+
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def object_etag(stat: os.stat_result) -> str:
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+# parts are joined inside the kernel where sendfile is available
+def append_file(path: str, target: BinaryIO) -> None:
+    with open(path, "rb") as source:
+        if not hasattr(os, "sendfile"):
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+            return
+
+        target.flush()
+        size = os.fstat(source.fileno()).st_size
+        offset = 0
+
+        while offset < size:
+            sent = os.sendfile(target.fileno(), source.fileno(), offset, size - offset)
+            if not sent:
+                raise StorageError(f"Could not append {path}.")
+            offset += sent
+
+
+class MmapObjectReader(ObjectReader):
+    """
+    Object file mapped into memory, chunks are sliced straight from the page cache
+    without a read() call per chunk.
+    """
+
+    def __init__(self, path: str, offset: int, length: int):
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            self.size = stat.st_size
+            self.etag = object_etag(stat)
+
+            # empty files can't be mapped
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else None
+
+        self.start = min(offset, self.size)
+        self.end = self.size if not length else min(offset + length, self.size)
+
+        if self.map is not None:
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def stream(self, chunk_size: int) -> Iterator[bytes]:
+        for position in range(self.start, self.end, chunk_size):
+            yield self.map[position:min(position + chunk_size, self.end)]
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class LocalBackend(StorageBackend):
+    """
+    Objects are plain files in one directory, written to a temporary file first
+    and moved into place, so a reader never sees a partly written object.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, ".tmp")
+        self.uploads_dir = os.path.join(self.root, ".uploads")
+
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.uploads_dir, exist_ok=True)
+
+    # names are quoted, so they can never point outside of the root
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, quote(name, safe=""))
+
+    def upload_path(self, upload_id: str) -> str:
+        return os.path.join(self.uploads_dir, quote(upload_id, safe=""))
+
+    def temporary_path(self) -> str:
+        return os.path.join(self.tmp_dir, uuid.uuid4().hex)
+
+    def put(self, name: str, stream: BinaryIO, length: int) -> None:
+        tmp = self.temporary_path()
+
+        try:
+            with open(tmp, "wb") as file:
+                remaining = length
+
+                while remaining:
+                    data = stream.read(min(COPY_BUFFER_SIZE, remaining))
+                    if not data:
+                        raise StorageError("The stream is shorter than its length.")
+                    
+                    file.write(data)
+                    remaining -= len(data)
+
+            os.replace(tmp, self.path(name))
+        except OSError as e:
+            raise StorageError(str(e))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def open(self, name: str, offset: int = 0, length: int = 0) -> ObjectReader:
+        try:
+            return MmapObjectReader(self.path(name), offset, length)
+        except FileNotFoundError as e:
+            raise ObjectNotFound(str(e))
+        except OSError as e:
+            raise StorageError(str(e))
+
+    def stat(self, name: str) -> ObjectStat:
+        try:
+            stat = os.stat(self.path(name))
+            return ObjectStat(stat.st_size, object_etag(stat))
+        except FileNotFoundError as e:
+            raise ObjectNotFound(str(e))
+        except OSError as e:
+            raise StorageError(str(e))
+
+    def delete(self, name: str) -> None:
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise StorageError(str(e))
+
+    def bulk_delete(self, names: list[str]) -> list[str]:
+        failed = []
+
+        for name in names:
+            try:
+                self.delete(name)
+            except StorageError as e:
+                logger.debug(f"Failed to delete {name}: {str(e)}")
+                failed.append(name)
+
+        return failed
+
+    # objects are never modified in place, so the copy can share the data with a hard link
+    def copy(self, source: str, target: str) -> None:
+        source_path = self.path(source)
+
+        if not os.path.exists(source_path):
+            raise ObjectNotFound(f"Object {source} does not exist.")
+
+        tmp = self.temporary_path()
+
+        try:
+            try:
+                os.link(source_path, tmp)
+            except OSError:
+                # not every filesystem supports hard links
+                shutil.copyfile(source_path, tmp)
+            
+            os.replace(tmp, self.path(target))
+        except OSError as e:
+            raise StorageError(str(e))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # the directory has to be sorted, so all names are held in memory; fine for a single node
+    def iter_objects(self) -> Iterator[StoredObject]:
+        try:
+            entries = sorted(
+                (unquote(entry.name), entry) for entry in os.scandir(self.root) if entry.is_file()
+            )
+        except OSError as e:
+            raise StorageError(str(e))
+
+        for name, entry in entries:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            # ctime also changes when a hard link is made, so a fresh copy never looks old
+            yield StoredObject(name, stat.st_size, datetime.fromtimestamp(stat.st_ctime, timezone.utc))
+
+    def create_multipart(self, name: str) -> str:
+        upload_id = uuid.uuid4().hex
+
+        try:
+            os.makedirs(self.upload_path(upload_id))
+            return upload_id
+        except OSError as e:
+            raise StorageError(str(e))
+
+    def upload_part(self, name: str, upload_id: str, part_number: int, data: bytes) -> str:
+        directory = self.upload_path(upload_id)
+
+        if not os.path.isdir(directory):
+            raise UploadNotFound(f"Upload {upload_id} does not exist.")
+
+        tmp = self.temporary_path()
+
+        try:
+            with open(tmp, "wb") as file:
+                file.write(data)
+
+            os.replace(tmp, os.path.join(directory, str(part_number)))
+            return hashlib.md5(data).hexdigest()
+        except OSError as e:
+            raise StorageError(str(e))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def complete_multipart(self, name: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        directory = self.upload_path(upload_id)
+
+        if not os.path.isdir(directory):
+            raise UploadNotFound(f"Upload {upload_id} does not exist.")
+
+        tmp = self.temporary_path()
+
+        try:
+            with open(tmp, "wb") as target:
+                for part_number, _ in parts:
+                    append_file(os.path.join(directory, str(part_number)), target)
+
+            os.replace(tmp, self.path(name))
+            shutil.rmtree(directory, ignore_errors=True)
+        except OSError as e:
+            raise StorageError(str(e))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def abort_multipart(self, name: str, upload_id: str) -> None:
+        directory = self.upload_path(upload_id)
+
+        if not os.path.isdir(directory):
+            raise UploadNotFound(f"Upload {upload_id} does not exist.")
+
+        shutil.rmtree(directory, ignore_errors=True)
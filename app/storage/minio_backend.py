@@ -0,0 +1,208 @@
+from minio import Minio, S3Error, InvalidResponseError
+from minio.deleteobjects import DeleteObject
+from minio.datatypes import Part
+from minio.commonconfig import CopySource
+from urllib3.exceptions import HTTPError
+from datetime import timedelta
+from typing import BinaryIO, Iterator, Callable
+from loguru import logger
+from app.storage.base import StorageBackend, ObjectReader, ObjectStat, StoredObject
+from app.storage.errors import StorageError, ObjectNotFound, UploadNotFound
+from app.storage.pool import StorageMetrics, InFlightLimiter, create_pool_manager, pool_stats
+from app.storage.schemas import StorageStats
+
+
+# timeouts and exhausted retries surface as urllib3 errors
+CLIENT_ERRORS = (S3Error, InvalidResponseError, HTTPError)
+
+
+def storage_error(e: Exception) -> StorageError:
+    if isinstance(e, S3Error) and e.code in ("NoSuchKey", "NoSuchObject"):
+        return ObjectNotFound(str(e))
+    if isinstance(e, S3Error) and e.code == "NoSuchUpload":
+        return UploadNotFound(str(e))
+    return StorageError(str(e))
+
+
+class MinioObjectReader(ObjectReader):
+    def __init__(self, response, release: Callable[[], None]):
+        self.response = response
+        self.release = release
+        self.size = int(response.headers.get("Content-Length", 0))
+        self.etag = response.headers.get("ETag", "").strip('"')
+        self._closed = False
+
+    def stream(self, chunk_size: int) -> Iterator[bytes]:
+        try:
+            yield from self.response.stream(chunk_size)
+        except (InvalidResponseError, HTTPError) as e:
+            raise StorageError(str(e))
+
+    # the connection goes back to the pool only after release_conn()
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            try:
+                self.response.close()
+                self.response.release_conn()
+            finally:
+                self.release()
+
+
+class MinioBackend(StorageBackend):
+    def __init__(
+        self, 
+        endpoint: str, 
+        access_key: str, 
+        secret_key: str, 
+        secure: bool, 
+        bucket_name: str,
+        public_endpoint: str,
+        region: str,
+        part_size: int,
+        max_in_flight: int,
+        acquire_timeout: float,
+        connect_timeout: float,
+        read_timeout: float,
+        retries: int,
+        retry_backoff: float):
+        # assuming the bucket is already created
+        self.bucket_name = bucket_name
+        self.part_size = part_size
+
+        self.metrics = StorageMetrics()
+        self.limiter = InFlightLimiter(max_in_flight, acquire_timeout, self.metrics)
+        self.http = create_pool_manager(
+            max_in_flight, connect_timeout, read_timeout, retries, retry_backoff, self.metrics
+        )
+        self.client = Minio(
+            endpoint, 
+            access_key=access_key, 
+            secret_key=secret_key, 
+            secure=secure, 
+            http_client=self.http
+        )
+
+        # only used to sign urls, which are then handed to clients;
+        # the region is fixed so that signing never needs a round trip to the server
+        self.presign_client = Minio(
+            public_endpoint or endpoint,
+            access_key=access_key,
+            secret_key=secret_key,
+            secure=secure,
+            region=region
+        )
+
+    def put(self, name: str, stream: BinaryIO, length: int) -> None:
+        try:
+            with self.limiter.slot():
+                # a single part is buffered at a time, so memory is bounded by part_size
+                self.client.put_object(
+                    self.bucket_name,
+                    name,
+                    data = stream,
+                    length = length,
+                    content_type = "application/octet-stream",
+                    part_size = self.part_size,
+                    num_parallel_uploads = 1
+                )
+        except CLIENT_ERRORS + (IOError, ValueError) as e:
+            raise storage_error(e)
+
+    def open(self, name: str, offset: int = 0, length: int = 0) -> ObjectReader:
+        # the slot is held until the reader is closed, since the connection is busy until then
+        self.limiter.acquire()
+
+        try:
+            response = self.client.get_object(self.bucket_name, name, offset=offset, length=length)
+            return MinioObjectReader(response, self.limiter.release)
+        except CLIENT_ERRORS as e:
+            self.limiter.release()
+            raise storage_error(e)
+
+    def stat(self, name: str) -> ObjectStat:
+        try:
+            with self.limiter.slot():
+                stat = self.client.stat_object(self.bucket_name, name)
+                return ObjectStat(stat.size, stat.etag)
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def delete(self, name: str) -> None:
+        try:
+            with self.limiter.slot():
+                self.client.remove_object(self.bucket_name, name)
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def bulk_delete(self, names: list[str]) -> list[str]:
+        try:
+            with self.limiter.slot():
+                failed = []
+                errors = self.client.remove_objects(self.bucket_name, [DeleteObject(name) for name in names])
+
+                # the deletion is lazy, it only happens while the errors are iterated
+                for error in errors:
+                    logger.debug(f"Failed to delete {error.name}: {error.message}")
+                    failed.append(error.name)
+
+                return failed
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def copy(self, source: str, target: str) -> None:
+        try:
+            with self.limiter.slot():
+                self.client.copy_object(self.bucket_name, target, CopySource(self.bucket_name, source))
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    # holds a single in-flight slot for the whole listing
+    def iter_objects(self) -> Iterator[StoredObject]:
+        try:
+            with self.limiter.slot():
+                for obj in self.client.list_objects(self.bucket_name, recursive=True):
+                    yield StoredObject(obj.object_name, obj.size, obj.last_modified)
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def create_multipart(self, name: str) -> str:
+        try:
+            with self.limiter.slot():
+                return self.client._create_multipart_upload(
+                    self.bucket_name, name, {"Content-Type": "application/octet-stream"}
+                )
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def upload_part(self, name: str, upload_id: str, part_number: int, data: bytes) -> str:
+        try:
+            with self.limiter.slot():
+                return self.client._upload_part(self.bucket_name, name, data, None, upload_id, part_number)
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def complete_multipart(self, name: str, upload_id: str, parts: list[tuple[int, str]]) -> None:
+        try:
+            with self.limiter.slot():
+                self.client._complete_multipart_upload(
+                    self.bucket_name, name, upload_id, [Part(number, etag) for number, etag in parts]
+                )
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def abort_multipart(self, name: str, upload_id: str) -> None:
+        try:
+            with self.limiter.slot():
+                self.client._abort_multipart_upload(self.bucket_name, name, upload_id)
+        except CLIENT_ERRORS as e:
+            raise storage_error(e)
+
+    def presign_put(self, name: str, expires: timedelta) -> str:
+        return self.presign_client.presigned_put_object(self.bucket_name, name, expires=expires)
+
+    def presign_get(self, name: str, expires: timedelta) -> str:
+        return self.presign_client.presigned_get_object(self.bucket_name, name, expires=expires)
+
+    def stats(self) -> StorageStats:
+        return pool_stats(self.http, self.limiter, self.metrics)
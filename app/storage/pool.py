@@ -0,0 +1,127 @@
+from urllib3 import PoolManager, Timeout
+from urllib3.util.retry import Retry
+from contextlib import contextmanager
+from loguru import logger
+from app.storage.errors import StorageSaturated
+from app.storage.schemas import StorageStats
+import threading
+import certifi
+
+
+class StorageMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.waited = 0
+        self.rejected = 0
+        self.retries = 0
+
+    def increment(self, counter: str) -> None:
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+class CountedRetry(Retry):
+    """
+    Retry policy that reports every retry to the metrics of the backend.
+    urllib3 copies the policy through new() on every attempt, so the metrics are kept on the class.
+    """
+
+    metrics: StorageMetrics = None
+
+    def increment(self, *args, **kwargs) -> Retry:
+        if self.metrics is not None:
+            self.metrics.increment("retries")
+        return super().increment(*args, **kwargs)
+
+
+class InFlightLimiter:
+    """
+    Per-process cap on storage operations that are running or holding a connection.
+    A caller waits for a free slot at most `timeout` seconds, then StorageSaturated is raised.
+    """
+
+    def __init__(self, limit: int, timeout: float, metrics: StorageMetrics):
+        self.limit = limit
+        self.timeout = timeout
+        self.metrics = metrics
+        self.semaphore = threading.BoundedSemaphore(limit)
+
+    def acquire(self) -> None:
+        if not self.semaphore.acquire(blocking=False):
+            self.metrics.increment("waited")
+
+            if not self.semaphore.acquire(timeout=self.timeout):
+                self.metrics.increment("rejected")
+                logger.debug(f"Storage is saturated, {self.limit} operations are in flight")
+                raise StorageSaturated("Too many storage operations are in progress, try again later.")
+
+        with self.metrics.lock:
+            self.metrics.in_flight += 1
+            self.metrics.peak_in_flight = max(self.metrics.peak_in_flight, self.metrics.in_flight)
+
+    def release(self) -> None:
+        with self.metrics.lock:
+            self.metrics.in_flight -= 1
+
+        self.semaphore.release()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+def create_pool_manager(
+    size: int, 
+    connect_timeout: float, 
+    read_timeout: float, 
+    retries: int, 
+    backoff: float, 
+    metrics: StorageMetrics) -> PoolManager:
+    retry_class = type("BackendRetry", (CountedRetry,), {"metrics": metrics})
+
+    return PoolManager(
+        # as large as the in-flight cap, so connections are reused instead of being dropped after a request
+        maxsize=size,
+        timeout=Timeout(connect=connect_timeout, read=read_timeout),
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=certifi.where(),
+        retries=retry_class(
+            total=retries,
+            backoff_factor=backoff,
+            # spreads the retries of requests that failed together
+            backoff_jitter=backoff,
+            status_forcelist=[500, 502, 503, 504],
+            # only idempotent methods are retried, POST (multipart create/complete, bulk delete) is not
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            # the last error response is handed to minio, so it's raised as S3Error
+            raise_on_status=False
+        )
+    )
+
+
+def pool_stats(manager: PoolManager, limiter: InFlightLimiter, metrics: StorageMetrics) -> StorageStats:
+    # the pool container only supports thread-safe access by key
+    pools = [pool for pool in map(manager.pools.get, manager.pools.keys()) if pool is not None]
+
+    with metrics.lock:
+        return StorageStats(
+            in_flight=metrics.in_flight,
+            peak_in_flight=metrics.peak_in_flight,
+            max_in_flight=limiter.limit,
+            waited=metrics.waited,
+            rejected=metrics.rejected,
+            retries=metrics.retries,
+            pool_size=manager.connection_pool_kw.get("maxsize", 0),
+            connections_opened=sum(pool.num_connections for pool in pools),
+            requests_sent=sum(pool.num_requests for pool in pools),
+            # the queue of a pool is padded with None up to maxsize
+            idle_connections=sum(
+                len([conn for conn in pool.pool.queue if conn is not None]) for pool in pools if pool.pool is not None
+            )
+        )
@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from app.auth.services import get_full_auth
+from app.auth.schemas import CurrentUser
+from app.storage.schemas import StorageStats
+from app.storage.errors import OperationNotSupported
+from app.files.utils import storage
+
+
+storage_router = APIRouter()
+
+
+@storage_router.get("/stats")
+def get_storage_stats(current_user: CurrentUser = Depends(get_full_auth)) -> StorageStats:
+    try:
+        return storage.stats()
+    except OperationNotSupported as e:
+        raise HTTPException(status_code=status.HTTP_501_NOT_IMPLEMENTED, detail=str(e))
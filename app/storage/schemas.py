@@ -0,0 +1,14 @@
+from pydantic import BaseModel
+
+
+class StorageStats(BaseModel):
+    in_flight: int
+    peak_in_flight: int
+    max_in_flight: int
+    waited: int
+    rejected: int
+    retries: int
+    pool_size: int
+    connections_opened: int
+    requests_sent: int
+    idle_connections: int
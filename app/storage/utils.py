@@ -0,0 +1,29 @@
+from app.storage.base import StorageBackend
+from app.environment import Settings
+
+
+def create_storage_backend(settings: Settings) -> StorageBackend:
+    if settings.STORAGE_BACKEND == "local":
+        from app.storage.local_backend import LocalBackend
+        return LocalBackend(settings.LOCAL_STORAGE_PATH)
+    
+    if settings.STORAGE_BACKEND == "minio":
+        from app.storage.minio_backend import MinioBackend
+        return MinioBackend(
+            settings.MINIO_ENDPOINT,
+            settings.MINIO_LOGIN,
+            settings.MINIO_PASSWORD,
+            settings.MINIO_SECURE,
+            settings.BUCKET_NAME,
+            settings.MINIO_PUBLIC_ENDPOINT,
+            settings.MINIO_REGION,
+            settings.UPLOAD_PART_SIZE,
+            settings.STORAGE_MAX_IN_FLIGHT,
+            settings.STORAGE_ACQUIRE_TIMEOUT,
+            settings.STORAGE_CONNECT_TIMEOUT,
+            settings.STORAGE_READ_TIMEOUT,
+            settings.STORAGE_RETRIES,
+            settings.STORAGE_RETRY_BACKOFF
+        )
+    
+    raise ValueError(f"Unknown storage backend: {settings.STORAGE_BACKEND}")
@@ -0,0 +1,5 @@
+class InvalidChangeCursor(Exception):
+    pass
+
+class ExpiredChangeCursor(Exception):
+    pass
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from sqlalchemy.orm import Session
+from typing import Annotated
+from app.database import get_db
+from app.auth.services import get_basic_auth
+from app.auth.schemas import CurrentUser
+from app.sync.schemas import ChangesQuery, ChangesPage
+from app.sync.services import get_changes
+from app.sync.errors import InvalidChangeCursor, ExpiredChangeCursor
+
+
+sync_router = APIRouter()
+
+
+@sync_router.get("/changes")
+def changes(
+    query: Annotated[ChangesQuery, Query()],
+    current_user: CurrentUser = Depends(get_basic_auth),
+    db: Session = Depends(get_db)) -> ChangesPage:
+    try:
+        return get_changes(current_user, query, db)
+    except InvalidChangeCursor as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except ExpiredChangeCursor as e:
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail=str(e))
@@ -0,0 +1,44 @@
+from pydantic import BaseModel, Field
+from enum import Enum
+from typing import Optional
+from datetime import datetime
+
+
+class ChangeEntity(str, Enum):
+    FOLDER = "folder"
+    FILE = "file"
+    # a file of the user shared with someone else
+    SHARE = "share"
+    # a file someone else shared with the user
+    SHARED_FILE = "shared_file"
+
+
+class ChangeAction(str, Enum):
+    CREATE = "create"
+    RENAME = "rename"
+    DELETE = "delete"
+
+
+class ChangesQuery(BaseModel):
+    cursor: Optional[str] = None
+    limit: int = Field(500, ge=1, le=1000)
+
+
+class ChangeOut(BaseModel):
+    id: int
+    entity: ChangeEntity
+    entity_id: int
+    action: ChangeAction
+    parent_id: Optional[int] = None
+    name: Optional[str] = None
+    peer_user_id: Optional[int] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class ChangesPage(BaseModel):
+    changes: list[ChangeOut]
+    cursor: str
+    has_more: bool
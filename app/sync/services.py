@@ -0,0 +1,25 @@
+from sqlalchemy.orm import Session
+from app.auth.schemas import CurrentUser
+from app.sync.schemas import ChangesQuery, ChangesPage, ChangeOut
+from app.sync.utils import decode_change_cursor, encode_change_cursor, latest_change_cursor, get_changes_after
+
+
+def get_changes(current_user: CurrentUser, query: ChangesQuery, db: Session) -> ChangesPage:
+    # without a cursor the feed starts now, the current state comes from /folders/tree
+    if query.cursor is None:
+        return ChangesPage(changes=[], cursor=latest_change_cursor(current_user.id, db), has_more=False)
+
+    last_id = decode_change_cursor(query.cursor)
+    events = get_changes_after(current_user.id, last_id, query.limit + 1, db)
+
+    has_more = len(events) > query.limit
+    events = events[:query.limit]
+
+    if events:
+        last_id = events[-1].id
+
+    return ChangesPage(
+        changes=[ChangeOut.model_validate(event) for event in events],
+        cursor=encode_change_cursor(last_id),
+        has_more=has_more
+    )
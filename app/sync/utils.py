@@ -0,0 +1,136 @@
+from sqlalchemy import select, insert, delete, func, and_, or_, exists
+from sqlalchemy.orm import Session, aliased
+from app.models import ChangeEvent
+from app.sync.schemas import ChangeEntity, ChangeAction
+from app.sync.errors import InvalidChangeCursor, ExpiredChangeCursor
+from app.database import get_db
+from app.main import settings
+from datetime import datetime, timedelta
+from loguru import logger
+from typing import Optional
+import schedule
+import threading
+import base64
+import time
+import json
+
+
+def change_row(
+    user_id: int,
+    entity: ChangeEntity,
+    action: ChangeAction,
+    entity_id: int,
+    parent_id: Optional[int] = None,
+    name: Optional[str] = None,
+    peer_user_id: Optional[int] = None) -> dict:
+    return {
+        "user_id": user_id,
+        "entity": entity.value,
+        "action": action.value,
+        "entity_id": entity_id,
+        "parent_id": parent_id,
+        "name": name,
+        "peer_user_id": peer_user_id,
+        "created_at": datetime.utcnow()
+    }
+
+
+# flushed with the caller's transaction, never committed here
+def record_change(db: Session, *args, **kwargs) -> None:
+    db.execute(insert(ChangeEvent), [change_row(*args, **kwargs)])
+
+
+def record_changes(db: Session, rows: list[dict]) -> None:
+    if rows:
+        db.execute(insert(ChangeEvent), rows)
+
+
+# events are only handed out once they are old enough that no transaction writing an older id is still open
+def settled_until() -> datetime:
+    return datetime.utcnow() - timedelta(seconds=settings.CHANGE_SETTLE_SECONDS)
+
+
+# the cursor is the last delivered event id and the moment (unix time) up to which the journal was read
+def encode_change_cursor(last_id: int) -> str:
+    read_until = time.time() - settings.CHANGE_SETTLE_SECONDS
+    return base64.urlsafe_b64encode(json.dumps([last_id, read_until]).encode("utf-8")).decode("ascii")
+
+
+def decode_change_cursor(cursor: str) -> int:
+    try:
+        last_id, read_until = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise InvalidChangeCursor("This cursor is invalid.")
+
+    if not isinstance(last_id, int) or not isinstance(read_until, (int, float)):
+        raise InvalidChangeCursor("This cursor is invalid.")
+
+    # events older than the retention period may already be gone
+    if read_until < time.time() - settings.CHANGE_RETENTION_HOURS * 3600:
+        raise ExpiredChangeCursor("This cursor has expired, the tree has to be fetched again.")
+
+    return last_id
+
+
+def latest_change_cursor(user_id: int, db: Session) -> str:
+    last_id = db.scalar(select(func.max(ChangeEvent.id)).where(ChangeEvent.user_id == user_id)) or 0
+    return encode_change_cursor(last_id)
+
+
+def get_changes_after(user_id: int, last_id: int, limit: int, db: Session) -> list[ChangeEvent]:
+    return db.scalars(
+        select(ChangeEvent)
+        .where(ChangeEvent.user_id == user_id, ChangeEvent.id > last_id, ChangeEvent.created_at <= settled_until())
+        .order_by(ChangeEvent.id)
+        .limit(limit)
+    ).all()
+
+
+def prune_change_events() -> None:
+    db = next(get_db())
+
+    try:
+        cutoff = datetime.utcnow() - timedelta(hours=settings.CHANGE_RETENTION_HOURS)
+        expired = db.execute(delete(ChangeEvent).where(ChangeEvent.created_at < cutoff)).rowcount
+
+        # a create or rename is superseded by a later delete of the same entity (and peer, for shares), a rename by a later rename
+        later = aliased(ChangeEvent)
+        compacted = db.execute(
+            delete(ChangeEvent).where(
+                ChangeEvent.action.in_([ChangeAction.CREATE.value, ChangeAction.RENAME.value]),
+                exists().where(
+                    later.user_id == ChangeEvent.user_id,
+                    later.entity == ChangeEvent.entity,
+                    later.entity_id == ChangeEvent.entity_id,
+                    later.peer_user_id.is_not_distinct_from(ChangeEvent.peer_user_id),
+                    later.id > ChangeEvent.id,
+                    or_(
+                        later.action == ChangeAction.DELETE.value,
+                        and_(later.action == ChangeAction.RENAME.value, ChangeEvent.action == ChangeAction.RENAME.value)
+                    )
+                )
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+
+        db.commit()
+        logger.debug(f"Change journal: {expired} expired and {compacted} superseded events removed")
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Could not prune the change journal: {e}")
+    finally:
+        db.close()
+
+
+def change_journal_task():
+    scheduler = schedule.Scheduler()
+    scheduler.every(settings.CHANGE_PRUNE_INTERVAL_MINUTES).minutes.do(prune_change_events)
+    while True:
+        scheduler.run_pending()
+        time.sleep(1)
+
+
+def initiate_change_journal_task():
+    logger.debug("Starting a thread to prune the change journal...")
+    task_thread = threading.Thread(target=change_journal_task)
+    task_thread.daemon = True
+    task_thread.start()